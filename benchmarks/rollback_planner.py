@@ -0,0 +1,59 @@
+#! /usr/bin/python
+
+import datetime
+import os
+import random
+import runpy
+import sys
+import time
+
+
+UPDATE_MODULE = f'{os.path.dirname(os.path.realpath(__file__))}/../modules/update.py'
+SIZES = [ 10_000, 100_000, 1_000_000 ]
+MAX_SLOWDOWN = 10.0 # allowed growth of time per operation between the smallest and the largest history, quadratic planners grow ~100x
+
+
+def generate_operations(log_operation: type, size: int) -> list:
+    rng = random.Random(size)
+    packages = [ f'package-{i}' for i in range(max(size // 10, 1)) ]
+    operations = rng.choices([ 'upgraded', 'installed', 'removed', 'reinstalled' ], weights=[ 80, 8, 8, 4 ], k=size)
+    timestamp = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    history = []
+    for offset, operation in enumerate(operations):
+        version = f'{rng.randint(0, 99)}.{rng.randint(0, 99)}-1'
+        history.append(log_operation(timestamp, operation, rng.choice(packages), version, version, offset))
+
+    return history
+
+def measure(plan_rollback: object, operations: list) -> float:
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        plan_rollback(operations)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def main():
+    update = runpy.run_path(UPDATE_MODULE)
+    sizes = [ int(size) for size in sys.argv[1:] ] or SIZES
+
+    per_operation = []
+    print(f'{"operations":>12}{"seconds":>12}{"ns/op":>12}')
+    for size in sizes:
+        elapsed = measure(update['plan_rollback'], generate_operations(update['LogOperation'], size))
+        per_operation.append(elapsed / size)
+
+        print(f'{size:>12}{elapsed:>12.4f}{elapsed / size * 1e9:>12.1f}')
+
+    slowdown = per_operation[-1] / per_operation[0]
+    if slowdown > MAX_SLOWDOWN:
+        print(f'Planner scales super-linearly: time per operation grew {slowdown:.1f}x (allowed {MAX_SLOWDOWN}x)')
+        exit(1)
+
+
+if __name__=='__main__':
+    main()
@@ -1,16 +1,33 @@
 _name = 'package'
 _desc = 'Manage packages on your system by declaring them in a json file.'
 
+import contextlib
 import json
+import re
 import subprocess
 import os
+import tarfile
 import tempfile
-from dataclasses import dataclass
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import IO, Iterable, Iterator
 
 
 LISTFILE_DIR = f'{os.environ["HOME"]}/.config/sysman'
 LISTFILE = f'{LISTFILE_DIR}/packages.json'
-AUR_HELPER = 'yay'
+LOCAL_DB_CACHE = f'{LISTFILE_DIR}/tmp/local_db.json'
+LOCAL_DB_LOC = '/var/lib/pacman/local'
+SYNC_DB_CACHE = f'{LISTFILE_DIR}/tmp/sync_db.json'
+SYNC_DB_LOC = '/var/lib/pacman/sync'
+FLEET_DIFF_TOP = 10 # most commonly drifting packages shown in the fleet summary
+AUR_RPC_URL = 'https://aur.archlinux.org/rpc/v5/info'
+AUR_RPC_CHUNK = 100 # names per request, keeps the query string well below URL length limits
+AUR_RPC_TIMEOUT = 10 # seconds, an unresponsive AUR must not hang sync before its first prompt
+AUR_GIT_URL = 'https://aur.archlinux.org'
+AUR_BUILD_DIR = f'{os.environ["HOME"]}/.cache/sysman/aur'
+AUR_BUILD_WORKERS = 4
 
 
 @dataclass
@@ -27,86 +44,622 @@ class Package:
 
 
 @dataclass
-class PackagePrettified:
+class LocalPackage:
     name: str
-    comment: str
+    version: str
+    explicit: bool
+    size: int
+    depends: list[str]
+    optdepends: list[str]
+    provides: list[str]
+
+
+@dataclass
+class DependencyGraph:
+    packages: dict[str, LocalPackage]
+    depends: dict[str, set[str]]
+    optdepends: dict[str, set[str]]
+    required_by: dict[str, set[str]]
+    optional_for: dict[str, set[str]]
+
+    def closure(self, names: Iterable[str], optional: bool = False) -> set[str]:
+        reached = set()
+        stack = [ name for name in names if name in self.packages ]
+        while stack:
+            name = stack.pop()
+
+            if name in reached:
+                continue
+
+            reached.add(name)
+            stack.extend(self.depends[name] - reached)
+
+            if optional:
+                stack.extend(self.optdepends[name] - reached)
+
+        return reached
+
+    def footprint(self, names: Iterable[str]) -> int:
+        return sum(self.packages[name].size for name in names)
+
+    def orphans(self) -> set[str]:
+        # optional dependencies keep a package too, pacman -Qdt does not list optionally required packages either
+        return set(self.packages) - self.closure((name for name, package in self.packages.items() if package.explicit), optional=True)
 
 
 @dataclass
-class PackageGroup:
-    group_name: str
-    packages: list[str]
+class SyncIndex:
+    packages: dict[str, str] # package name -> repository
+    provides: dict[str, list[str]] # provided name -> packages providing it
+
+    def names(self) -> set[str]:
+        return set(self.packages) | set(self.provides)
+
+
+@dataclass
+class AurPackage:
+    name: str
+    base: str
+    depends: list[str] # runtime, make and check dependencies, without version constraints
+
+
+@dataclass
+class Listfile:
+    mtime: int
+    includes: list[str] # as written in the file, relative to its directory
+    groups: dict[str, list[Package]]
+
+    def packages(self) -> list[Package]:
+        return [ package for group_packages in self.groups.values() for package in group_packages ]
+
+
+listfile_cache: dict[str, Listfile] = {}
+
+
+def read_listfile(listfile_path: str) -> Listfile:
+    mtime = os.stat(listfile_path).st_mtime_ns
+
+    cached = listfile_cache.get(listfile_path)
+    if cached is not None and cached.mtime == mtime:
+        return cached
+
+    with open(listfile_path) as f:
+        data = json.load(f)
+
+    includes = []
+    groups = {}
+    for entry in data:
+        if 'include' in entry:
+            includes.append(entry['include'])
+            continue
 
+        group_name = entry['group_name']
+        groups.setdefault(group_name, []).extend(Package(package['name'], group_name, package['comment']) for package in entry['packages'])
 
-class CustomJsonEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, PackagePrettified | Package):
-            return f'##<{o.__dict__}>##'
+    listfile = Listfile(mtime, includes, groups)
+    listfile_cache[listfile_path] = listfile
 
+    return listfile
+
+def include_path(listfile_path: str, include: str) -> str:
+    return os.path.join(os.path.dirname(listfile_path), os.path.expanduser(include))
+
+def get_included_packages(listfile_path: str, includes: list[str], including: frozenset[str] = frozenset()) -> dict[str, Package]:
+    including = including | { os.path.realpath(listfile_path) }
+
+    packages = {}
+    for include in includes:
+        path = include_path(listfile_path, include)
+
+        if os.path.realpath(path) in including:
+            raise ValueError(f'Package file {path} includes itself')
+
+        listfile = read_listfile(path)
+        packages.update(get_included_packages(path, listfile.includes, including))
+        packages.update((package.name, package) for package in listfile.packages())
+
+    return packages
 
 def get_listfile_packages(listfile_path: str) -> set[Package]:
-    listfile_packages = []
+    if not os.path.exists(listfile_path):
+        return set()
+
+    listfile = read_listfile(listfile_path)
+
+    # entries of the file itself override the ones it includes
+    listfile_packages = get_included_packages(listfile_path, listfile.includes)
+    listfile_packages.update((package.name, package) for package in listfile.packages())
+
+    return set(listfile_packages.values())
+
+def parse_desc(path: str) -> dict[str, list[str]]:
+    with open(path) as f:
+        return parse_desc_text(f.read())
+
+def parse_desc_text(text: str) -> dict[str, list[str]]:
+    blocks = text.split('\n\n')
+
+    sections = {}
+    for block in blocks:
+        lines = block.strip('\n').split('\n')
+
+        if lines[0].startswith('%') and lines[0].endswith('%'):
+            sections[lines[0][1:-1]] = lines[1:]
+
+    return sections
+
+def read_local_db(db_path: str) -> list[LocalPackage]:
+    local_packages = []
+    with os.scandir(db_path) as entries:
+        for entry in entries:
+            if not entry.is_dir() or not os.path.isfile(f'{entry.path}/desc'):
+                continue
+
+            desc = parse_desc(f'{entry.path}/desc')
+            local_packages.append(LocalPackage(
+                desc['NAME'][0],
+                desc['VERSION'][0],
+                desc.get('REASON', ['0'])[0] == '0', # missing reason means explicitly installed
+                int(desc.get('SIZE', ['0'])[0]),
+                desc.get('DEPENDS', []),
+                [ optdepend.split(':')[0] for optdepend in desc.get('OPTDEPENDS', []) ],
+                desc.get('PROVIDES', [])
+            ))
+
+    return local_packages
+
+def local_db_mtime() -> list[int]:
+    # pacman -D --asexplicit/--asdeps rewrites desc files without touching the directory, so their newest mtime is part of the key
+    desc_mtimes = []
+    with os.scandir(LOCAL_DB_LOC) as entries:
+        for entry in entries:
+            try:
+                desc_mtimes.append(os.stat(f'{entry.path}/desc').st_mtime_ns)
+
+            except OSError:
+                continue
+
+    return [ os.stat(LOCAL_DB_LOC).st_mtime_ns, max(desc_mtimes, default=0) ]
+
+def get_local_packages() -> list[LocalPackage]:
+    mtime = local_db_mtime()
+
+    try:
+        with open(LOCAL_DB_CACHE) as f:
+            cache = json.load(f)
+
+        if cache['mtime'] == mtime:
+            return [ LocalPackage(**package) for package in cache['packages'] ]
+
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+
+    local_packages = read_local_db(LOCAL_DB_LOC)
+
+    tmp_cache = f'{LOCAL_DB_CACHE}.{os.getpid()}'
+    with open(tmp_cache, mode='w+') as f:
+        json.dump({ 'mtime': mtime, 'packages': [ asdict(package) for package in local_packages ] }, f)
+
+    os.replace(tmp_cache, LOCAL_DB_CACHE)
 
-    if os.path.exists(listfile_path):
-        with open(listfile_path) as f:
-            data = json.load(f)
+    return local_packages
 
-            for pac_group in data:
-                group_name = pac_group['group_name']
-                listfile_packages = listfile_packages + [ Package(package['name'], group_name, package['comment']) for package in pac_group['packages'] ]
+@contextlib.contextmanager
+def open_sync_db(path: str) -> Iterator[IO[bytes]]:
+    with open(path, 'rb') as f:
+        magic = f.read(4)
 
-    listfile_packages = set(listfile_packages)
+    if magic == b'\x28\xb5\x2f\xfd': # zstd, not supported by tarfile
+        process = subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE)
 
-    return listfile_packages
+        try:
+            yield process.stdout
+
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    else:
+        with open(path, 'rb') as f:
+            yield f
+
+def read_sync_db(path: str) -> dict[str, list[str]]:
+    # streams the archive member by member, only the desc files are read
+    packages = {}
+    with open_sync_db(path) as f, tarfile.open(fileobj=f, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith('/desc'):
+                continue
+
+            desc = parse_desc_text(archive.extractfile(member).read().decode())
+            packages[desc['NAME'][0]] = [ dependency_name(provided) for provided in desc.get('PROVIDES', []) ]
+
+    return packages
+
+def get_sync_index() -> SyncIndex:
+    db_files = sorted(file for file in os.listdir(SYNC_DB_LOC) if file.endswith('.db'))
+
+    try:
+        with open(SYNC_DB_CACHE) as f:
+            cache = json.load(f)['repos']
+
+    except (OSError, ValueError, TypeError, KeyError):
+        cache = {}
+
+    # every database is cached separately, a refresh of one repository does not re-read the others
+    repos = {}
+    for db_file in db_files:
+        repo = db_file[:-len('.db')]
+        mtime = os.stat(f'{SYNC_DB_LOC}/{db_file}').st_mtime_ns
+
+        if repo in cache and cache[repo].get('mtime') == mtime:
+            repos[repo] = cache[repo]
+
+        else:
+            repos[repo] = { 'mtime': mtime, 'packages': read_sync_db(f'{SYNC_DB_LOC}/{db_file}') }
+
+    if repos != cache:
+        tmp_cache = f'{SYNC_DB_CACHE}.{os.getpid()}'
+        with open(tmp_cache, mode='w+') as f:
+            json.dump({ 'repos': repos }, f)
+
+        os.replace(tmp_cache, SYNC_DB_CACHE)
+
+    # pacman.conf order is not known here, a package in several repositories is attributed to the first one alphabetically
+    packages = {}
+    provides = {}
+    for repo, data in repos.items():
+        for name, provided_names in data['packages'].items():
+            packages.setdefault(name, repo)
+
+            for provided in provided_names:
+                provides.setdefault(provided, []).append(name)
+
+    return SyncIndex(packages, provides)
+
+def classify_missing_packages(names: Iterable[str]) -> dict[str, list[str]]:
+    index = get_sync_index()
+
+    classes = { 'repo': [], 'provided': [], 'aur': [], 'unknown': [] }
+    candidates = []
+    for name in sorted(names):
+        if name in index.packages:
+            classes['repo'].append(name)
+
+        elif name in index.provides:
+            classes['provided'].append(f'{name} (by {", ".join(index.provides[name])})')
+
+        else:
+            candidates.append(name)
+
+    if len(candidates) > 0:
+        try:
+            found = query_aur(candidates)
+
+        except (OSError, ValueError): # AUR unreachable or answering garbage, nothing can be ruled out
+            found = set(candidates)
+
+        classes['aur'] = [ name for name in candidates if name in found ]
+        classes['unknown'] = [ name for name in candidates if name not in found ]
+
+    return classes
+
+def dependency_name(dependency: str) -> str:
+    return re.split('[<>=]', dependency, 1)[0]
+
+def build_dependency_graph(local_packages: list[LocalPackage]) -> DependencyGraph:
+    packages = { package.name: package for package in local_packages }
+
+    # every installed package satisfying a dependency counts as required, like pacman -Qdt does
+    providers = { name: { name } for name in packages }
+    for package in local_packages:
+        for provided in package.provides:
+            providers.setdefault(dependency_name(provided), set()).add(package.name)
+
+    depends = { name: set() for name in packages }
+    optdepends = { name: set() for name in packages }
+    required_by = { name: set() for name in packages }
+    optional_for = { name: set() for name in packages }
+    for package in local_packages:
+        for dependencies, edges, reverse_edges in [ (package.depends, depends, required_by), (package.optdepends, optdepends, optional_for) ]:
+            for dependency in dependencies:
+                for provider in providers.get(dependency_name(dependency), set()) - { package.name }:
+                    edges[package.name].add(provider)
+                    reverse_edges[provider].add(package.name)
+
+    return DependencyGraph(packages, depends, optdepends, required_by, optional_for)
 
 def get_all_packages() -> set[Package]:
-    pacman_output = subprocess.run(['pacman', '-Qqe'], stdout=subprocess.PIPE, text=True)
-    pacman_output = pacman_output.stdout.split('\n')[:-1]
+    if not os.path.isdir(LOCAL_DB_LOC): # custom DBPath, ask pacman instead
+        pacman_output = subprocess.run(['pacman', '-Qqe'], stdout=subprocess.PIPE, text=True)
+        pacman_output = pacman_output.stdout.split('\n')[:-1]
+
+        return set([ Package(package, '', '') for package in pacman_output ])
 
-    all_packages = set([ Package(package, '', '') for package in pacman_output ])
+    all_packages = set([ Package(package.name, '', '') for package in get_local_packages() if package.explicit ])
 
     return all_packages
 
 def affirmative(decision: str) -> bool:
     return decision in ['Y', 'y', 'yes', 'Yes', 'YES']
 
-def install_packages(packages: set[Package]) -> None:
-    pkgs = [ package.name for package in packages ]
-    subprocess.run([AUR_HELPER, '-S', *pkgs])
+def get_repo_packages() -> set[str]:
+    if os.path.isdir(SYNC_DB_LOC):
+        return get_sync_index().names()
+
+    pacman_output = subprocess.run(['pacman', '-Slq'], stdout=subprocess.PIPE, text=True)
+    pacman_output = pacman_output.stdout.split('\n')[:-1]
+
+    return set(pacman_output)
+
+def get_installed_names() -> set[str]:
+    if not os.path.isdir(LOCAL_DB_LOC):
+        pacman_output = subprocess.run(['pacman', '-Qq'], stdout=subprocess.PIPE, text=True)
+
+        return set(pacman_output.stdout.split('\n')[:-1])
+
+    installed = set()
+    for package in get_local_packages():
+        installed.add(package.name)
+        installed.update(dependency_name(provided) for provided in package.provides)
+
+    return installed
+
+def query_aur(names: list[str]) -> dict[str, AurPackage]:
+    aur_packages = {}
+    for i in range(0, len(names), AUR_RPC_CHUNK):
+        query = urllib.parse.urlencode([ ('arg[]', name) for name in names[i:i + AUR_RPC_CHUNK] ])
+
+        with urllib.request.urlopen(f'{AUR_RPC_URL}?{query}', timeout=AUR_RPC_TIMEOUT) as response:
+            results = json.load(response)['results']
+
+        for result in results:
+            dependencies = result.get('Depends', []) + result.get('MakeDepends', []) + result.get('CheckDepends', [])
+            aur_packages[result['Name']] = AurPackage(result['Name'], result['PackageBase'], [ dependency_name(dependency) for dependency in dependencies ])
+
+    return aur_packages
+
+def resolve_aur_packages(names: list[str], repo_packages: set[str], installed: set[str]) -> tuple[dict[str, AurPackage], set[str], set[str]]:
+    aur_packages = query_aur(names)
+    not_found = set(names) - set(aur_packages)
+
+    # walk dependencies of the AUR packages, whatever the AUR does not know is left for pacman to resolve, e.g. provided names
+    repo_dependencies = set()
+    pending = list(aur_packages.values())
+    while pending:
+        missing = set()
+        for package in pending:
+            for dependency in package.depends:
+                if dependency in installed or dependency in aur_packages:
+                    continue
+
+                if dependency in repo_packages:
+                    repo_dependencies.add(dependency)
+
+                else:
+                    missing.add(dependency)
+
+        found = query_aur(sorted(missing)) if missing else {}
+        repo_dependencies.update(missing - set(found))
+        aur_packages.update(found)
+        pending = list(found.values())
+
+    return aur_packages, repo_dependencies, not_found
+
+def aur_build_levels(aur_packages: dict[str, AurPackage]) -> list[list[str]]:
+    bases = { package.base for package in aur_packages.values() }
+    needs = { base: set() for base in bases }
+    for package in aur_packages.values():
+        for dependency in package.depends:
+            if dependency in aur_packages and aur_packages[dependency].base != package.base:
+                needs[package.base].add(aur_packages[dependency].base)
+
+    levels = []
+    built = set()
+    while len(built) < len(bases):
+        level = sorted(base for base in bases - built if needs[base] <= built)
 
-def uninstall_packages(packages: set[Package]) -> None:
+        if len(level) == 0:
+            raise ValueError(f'AUR packages have circular dependencies: {", ".join(sorted(bases - built))}')
+
+        levels.append(level)
+        built.update(level)
+
+    return levels
+
+def package_file_name(path: str) -> str:
+    return os.path.basename(path).partition('.pkg.tar')[0].rsplit('-', 3)[0]
+
+def fetch_aur_package(base: str) -> None:
+    build_dir = f'{AUR_BUILD_DIR}/{base}'
+
+    with open(f'{AUR_BUILD_DIR}/{base}.log', mode='w+') as log:
+        if os.path.isdir(build_dir):
+            subprocess.run(['git', '-C', build_dir, 'pull', '--ff-only'], stdout=log, stderr=subprocess.STDOUT, check=True)
+
+        else:
+            subprocess.run(['git', 'clone', f'{AUR_GIT_URL}/{base}.git', build_dir], stdout=log, stderr=subprocess.STDOUT, check=True)
+
+def review_aur_packages(bases: list[str]) -> None:
+    # like the diff menu of AUR helpers, only changes since the last reviewed commit are shown
+    empty_tree = subprocess.run(['git', 'hash-object', '-t', 'tree', '/dev/null'], stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
+
+    for base in bases:
+        build_dir = f'{AUR_BUILD_DIR}/{base}'
+        head = subprocess.run(['git', '-C', build_dir, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
+
+        try:
+            with open(f'{AUR_BUILD_DIR}/{base}.reviewed') as f:
+                reviewed = f.read().strip()
+
+        except OSError:
+            reviewed = empty_tree
+
+        if reviewed == head:
+            continue
+
+        if subprocess.run(['git', '-C', build_dir, 'diff', reviewed, head]).returncode != 0: # reviewed commit rewritten upstream
+            subprocess.run(['git', '-C', build_dir, 'diff', empty_tree, head])
+        decision = input(f'Build {base} from this PKGBUILD? y/N: ')
+
+        if not affirmative(decision):
+            raise PermissionError(f'PKGBUILD of {base} was not accepted, AUR packages were not installed.')
+
+        with open(f'{AUR_BUILD_DIR}/{base}.reviewed', mode='w+') as f:
+            f.write(f'{head}\n')
+
+def build_aur_package(base: str) -> list[str]:
+    build_dir = f'{AUR_BUILD_DIR}/{base}'
+
+    with open(f'{AUR_BUILD_DIR}/{base}.log', mode='a') as log:
+        package_files = subprocess.run(['makepkg', '--packagelist'], cwd=build_dir, stdout=subprocess.PIPE, stderr=log, text=True, check=True)
+        package_files = package_files.stdout.split('\n')[:-1]
+
+        if not all(os.path.exists(package_file) for package_file in package_files):
+            subprocess.run(['makepkg', '--noconfirm', '--force'], cwd=build_dir, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+    return package_files
+
+def install_package_files(package_files: list[str], names: set[str], installed: set[str], noconfirm: bool) -> None:
+    if len(package_files) == 0:
+        return
+
+    subprocess.run(['sudo', 'pacman', '-U', '--needed', *(['--noconfirm'] if noconfirm else []), *package_files], check=True)
+
+    # one transaction installs everything as explicit, newly installed packages nobody asked for become dependencies afterwards
+    dependencies = sorted({ package_file_name(package_file) for package_file in package_files } - names - installed)
+    if len(dependencies) > 0:
+        subprocess.run(['sudo', 'pacman', '-D', '--asdeps', *dependencies], check=True)
+
+def install_aur_packages(names: set[str], aur_packages: dict[str, AurPackage], installed: set[str], noconfirm: bool) -> None:
+    os.makedirs(AUR_BUILD_DIR, exist_ok=True)
+
+    levels = aur_build_levels(aur_packages)
+    bases = [ base for level in levels for base in level ]
+
+    with ThreadPoolExecutor(AUR_BUILD_WORKERS) as executor:
+        print(f'Fetching PKGBUILDs of {", ".join(bases)}...')
+        list(executor.map(fetch_aur_package, bases))
+
+        if not noconfirm:
+            review_aur_packages(bases)
+
+        # packages other bases are built against have to be installed before them, everything else waits for the final transaction
+        needed = {
+            dependency
+            for package in aur_packages.values()
+            for dependency in package.depends
+            if dependency in aur_packages and aur_packages[dependency].base != package.base
+        }
+
+        deferred_files = []
+        for level in levels:
+            print(f'Building {", ".join(level)}...')
+
+            package_files = [
+                package_file
+                for base_files in executor.map(build_aur_package, level)
+                for package_file in base_files
+                if package_file_name(package_file) in aur_packages
+            ]
+
+            install_package_files([ package_file for package_file in package_files if package_file_name(package_file) in needed ], names, installed, noconfirm)
+            deferred_files.extend(package_file for package_file in package_files if package_file_name(package_file) not in needed)
+
+    install_package_files(deferred_files, names, installed, noconfirm)
+
+def install_packages(packages: set[Package], noconfirm: bool = False, allow_aur: bool = True) -> None:
+    pkgs = sorted(package.name for package in packages)
+
+    repo_packages = get_repo_packages()
+    repo_pkgs = [ pkg for pkg in pkgs if pkg in repo_packages ]
+    aur_pkgs = [ pkg for pkg in pkgs if pkg not in repo_packages ]
+
+    if len(aur_pkgs) > 0 and not allow_aur:
+        raise PermissionError(f'Packages {", ".join(aur_pkgs)} would be built from AUR PKGBUILDs that were not reviewed, give --allow-aur to install them.')
+
+    installed = get_installed_names()
+    aur_packages, repo_dependencies, not_found = resolve_aur_packages(aur_pkgs, repo_packages, installed) if aur_pkgs else ({}, set(), set())
+
+    if len(not_found) > 0:
+        raise FileNotFoundError(f'Packages not found in the repositories nor the AUR: {", ".join(sorted(not_found))}')
+
+    if len(repo_pkgs) > 0:
+        subprocess.run(['sudo', 'pacman', '-S', '--needed', *(['--noconfirm'] if noconfirm else []), *repo_pkgs], check=True)
+
+    repo_dependencies = sorted(repo_dependencies - set(repo_pkgs))
+    if len(repo_dependencies) > 0:
+        subprocess.run(['sudo', 'pacman', '-S', '--needed', '--asdeps', *(['--noconfirm'] if noconfirm else []), *repo_dependencies], check=True)
+
+    if len(aur_packages) > 0:
+        install_aur_packages(set(aur_pkgs), aur_packages, installed, noconfirm)
+
+def uninstall_packages(packages: set[Package], noconfirm: bool = False) -> None:
     pkgs = [ package.name for package in packages ]
-    subprocess.run(['sudo', 'pacman', '-Rs', *pkgs])
+    subprocess.run(['sudo', 'pacman', '-Rs', *(['--noconfirm'] if noconfirm else []), *pkgs])
+
+def dump_packages(f: IO[str], packages: list[Package]) -> None:
+    f.write('[\n')
+    for i, package in enumerate(packages):
+        f.write(f'    {{"name": {json.dumps(package.name, ensure_ascii=False)}, "group": {json.dumps(package.group, ensure_ascii=False)}, "comment": {json.dumps(package.comment, ensure_ascii=False)}}}')
+        f.write(',\n' if i < len(packages) - 1 else '\n')
 
-def json_dump_correct_format(obj: list) -> str:
-    formatted_json = json.dumps(obj, indent=4, cls=CustomJsonEncoder)
-    formatted_json = formatted_json.replace('"##<', "").replace('>##"', "").replace('\'', "\"")
+    f.write(']')
 
-    return formatted_json
+def dump_listfile(f: IO[str], includes: list[str], groups: dict[str, list[Package]]) -> None:
+    group_names = sorted(groups, key=lambda x: x.lower() if x != '' else '\u00a0') # ungrouped packages go last
+
+    entries = len(includes) + len(group_names)
+    f.write('[\n')
+    for include in includes:
+        entries -= 1
+        f.write(f'    {{"include": {json.dumps(include, ensure_ascii=False)}}}')
+        f.write(',\n' if entries > 0 else '\n')
+
+    for group_name in group_names:
+        group_packages = sorted(groups[group_name], key=lambda x: x.name.lower())
+
+        f.write('    {\n')
+        f.write(f'        "group_name": {json.dumps(group_name, ensure_ascii=False)},\n')
+        f.write('        "packages": [\n')
+        for i, package in enumerate(group_packages):
+            f.write(f'            {{"name": {json.dumps(package.name, ensure_ascii=False)}, "comment": {json.dumps(package.comment, ensure_ascii=False)}}}')
+            f.write(',\n' if i < len(group_packages) - 1 else '\n')
+
+        entries -= 1
+        f.write('        ]\n')
+        f.write('    },\n' if entries > 0 else '    }\n')
+
+    f.write(']')
 
 def save_packages_to_listfile(listfile: str, packages: set[Package]) -> None:
-    package_groups = { package.group for package in packages }
+    includes = read_listfile(listfile).includes if os.path.exists(listfile) else []
+    included_packages = get_included_packages(listfile, includes)
+
+    kept_packages = set(included_packages) - { package.name for package in packages }
+    if len(kept_packages) > 0:
+        print(f'Packages {", ".join(sorted(kept_packages))} come from included files, remove them there.')
 
-    parsed_package_groups = []
-    for group in package_groups:
-        sorted_group_packages = sorted([
-            PackagePrettified(package.name, package.comment)
-            for package in packages
-            if package.group == group ], key=lambda x: x.name.lower()
-        )
+    # packages unchanged from an included file stay there, only overrides and additions are written to this one
+    groups = {}
+    for package in packages:
+        included = included_packages.get(package.name)
 
-        parsed_package_groups.append(PackageGroup(group, sorted_group_packages))
+        if included is None or (included.group, included.comment) != (package.group, package.comment):
+            groups.setdefault(package.group, []).append(package)
 
-    parsed_package_groups = sorted(parsed_package_groups, key=lambda x: x.group_name.lower() if x.group_name != '' else ' ') # else &nbsp
+    target = os.path.realpath(listfile)
+    tmp_listfile = f'{target}.{os.getpid()}'
+    with open(tmp_listfile, mode='w+') as f:
+        dump_listfile(f, includes, groups)
 
-    with open(listfile, mode='w+') as f:
-        f.write(json_dump_correct_format([ group.__dict__ for group in parsed_package_groups ]))
+    os.replace(tmp_listfile, target)
 
 def get_user_edited_packages(unedited_packages: set[Package]) -> list[Package]:
     sorted_unedited_packages = sorted(unedited_packages, key=lambda x: x.name.lower())
 
     tmp = tempfile.NamedTemporaryFile(delete=False, mode='w')
-    tmp.write(json_dump_correct_format(sorted_unedited_packages))
+    dump_packages(tmp, sorted_unedited_packages)
     tmp.close()
 
     subprocess.run([os.environ['EDITOR'], tmp.name])
@@ -134,11 +687,26 @@ def sync():
 
     if sys_missing_packages_count > 0:
         print(f'There are {sys_missing_packages_count} packages missing from the system:')
-        print(', '.join(sorted([ package.name for package in sys_missing_packages ])))
+
+        unknown_packages = set()
+        if os.path.isdir(SYNC_DB_LOC):
+            classes = classify_missing_packages(package.name for package in sys_missing_packages)
+            unknown_packages = { package for package in sys_missing_packages if package.name in classes['unknown'] }
+
+            for label, key in [ ('repository', 'repo'), ('provided', 'provided'), ('AUR', 'aur'), ('unknown', 'unknown') ]:
+                if len(classes[key]) > 0:
+                    print(f'{label + ":":<12}{", ".join(classes[key])}')
+
+        else:
+            print(', '.join(sorted([ package.name for package in sys_missing_packages ])))
+
         decision = input('Install them? y/N: ')
 
         if affirmative(decision):
-            install_packages(sys_missing_packages)
+            if len(unknown_packages) > 0:
+                print(f'Skipping {len(unknown_packages)} packages not found in the repositories nor the AUR.')
+
+            install_packages(sys_missing_packages - unknown_packages)
 
         else:
             decision = input('Remove these packages from the list? y/N: ')
@@ -168,6 +736,177 @@ def sync():
             if affirmative(decision):
                 uninstall_packages(list_missing_packages)
 
+    # 3. dependencies are no longer required by any explicitly installed package
+    if os.path.isdir(LOCAL_DB_LOC):
+        graph = build_dependency_graph(get_local_packages())
+        orphans = graph.orphans()
+
+        if len(orphans) > 0:
+            print(f'There are {len(orphans)} orphaned dependencies taking {graph.footprint(orphans) / 1024 ** 2:.1f} MiB:')
+            print(', '.join(sorted(orphans)))
+            decision = input('Remove them from the system? y/N: ')
+
+            if affirmative(decision):
+                uninstall_packages({ Package(orphan, '', '') for orphan in orphans })
+
+def plan(remove_unlisted: bool, remove_orphans: bool) -> dict[str, list]:
+    listfile_packages = get_listfile_packages(LISTFILE)
+    system_packages = get_all_packages()
+
+    unlisted = sorted(package.name for package in system_packages - listfile_packages)
+    orphans = sorted(build_dependency_graph(get_local_packages()).orphans()) if os.path.isdir(LOCAL_DB_LOC) else []
+
+    # nothing is removed unless asked for, the orchestrator can also move unlisted packages to 'add_to_list' or 'remove' itself
+    return {
+        'install': sorted(package.name for package in listfile_packages - system_packages),
+        'remove': sorted(set(unlisted if remove_unlisted else []) | set(orphans if remove_orphans else [])),
+        'add_to_list': [],
+        'unlisted': unlisted,
+        'orphans': orphans
+    }
+
+def apply(plan_file: str, allow_aur: bool):
+    with open(plan_file) as f:
+        plan = json.load(f)
+
+    to_install = { Package(name, '', '') for name in plan.get('install', []) }
+    to_remove = { Package(name, '', '') for name in plan.get('remove', []) }
+    to_add = { Package(package['name'], package.get('group', ''), package.get('comment', '')) for package in plan.get('add_to_list', []) }
+
+    if len(to_install) > 0:
+        print(f'Installing {len(to_install)} packages...')
+        install_packages(to_install, noconfirm=True, allow_aur=allow_aur)
+
+    installed = get_installed_names()
+    to_remove = { package for package in to_remove if package.name in installed }
+    if len(to_remove) > 0:
+        print(f'Removing {len(to_remove)} packages...')
+        uninstall_packages(to_remove, noconfirm=True)
+
+    if len(to_add) > 0:
+        print(f'Adding {len(to_add)} packages to the list...')
+        save_packages_to_listfile(LISTFILE, get_listfile_packages(LISTFILE) | to_add)
+
+def read_host_snapshot(path: str) -> list[str]:
+    if os.path.isdir(path):
+        db_path = f'{path}/local' if os.path.isdir(f'{path}/local') else path # copy of the whole DBPath or of local/ only
+
+        return [ package.name for package in read_local_db(db_path) if package.explicit ]
+
+    with open(path) as f: # pacman -Qqe output
+        return f.read().split()
+
+def bit_indices(mask: int) -> Iterator[int]:
+    # scanning the binary string avoids a big integer operation per set bit
+    bits = bin(mask)[:1:-1]
+
+    index = bits.find('1')
+    while index >= 0:
+        yield index
+        index = bits.find('1', index + 1)
+
+def add_to_counter(planes: list[int], mask: int) -> None:
+    # bit-sliced counter, planes[k] holds bit k of the count of every name, a host costs a few big integer operations
+    for k, plane in enumerate(planes):
+        planes[k] = plane ^ mask
+        mask = plane & mask
+
+        if mask == 0:
+            return
+
+    planes.append(mask)
+
+def read_counter(planes: list[int], size: int) -> list[int]:
+    counts = [ 0 ] * size
+    for k, plane in enumerate(planes):
+        for index in bit_indices(plane):
+            counts[index] += 1 << k
+
+    return counts
+
+def fleet_diff(listfile_path: str, snapshot_dir: str):
+    if not os.path.exists(listfile_path):
+        raise FileNotFoundError(f'Package file {listfile_path} does not exist')
+
+    # every package name is interned once, hosts and the package file become bitsets over the name table
+    name_table = {}
+    def to_bitset(names: Iterable[str]) -> int:
+        indices = [ name_table.setdefault(name, len(name_table)) for name in names ]
+
+        bitmap = bytearray(len(name_table) // 8 + 1)
+        for index in indices:
+            bitmap[index >> 3] |= 1 << (index & 7)
+
+        return int.from_bytes(bitmap, 'little')
+
+    declared = to_bitset(package.name for package in get_listfile_packages(listfile_path))
+
+    hosts = []
+    for entry in sorted(os.listdir(snapshot_dir)):
+        installed = to_bitset(read_host_snapshot(f'{snapshot_dir}/{entry}'))
+
+        hosts.append((os.path.splitext(entry)[0] if os.path.isfile(f'{snapshot_dir}/{entry}') else entry, declared & ~installed, installed & ~declared))
+
+    missing_counter = []
+    extra_counter = []
+
+    print(f'{"HOST":<40}{"MISSING":>10}{"EXTRA":>10}')
+    for host, missing, extra in hosts:
+        add_to_counter(missing_counter, missing)
+        add_to_counter(extra_counter, extra)
+
+        print(f'{host:<40}{missing.bit_count():>10}{extra.bit_count():>10}')
+
+    names = list(name_table)
+    missing_hosts = read_counter(missing_counter, len(names))
+    extra_hosts = read_counter(extra_counter, len(names))
+
+    in_sync = sum(1 for _, missing, extra in hosts if missing == 0 and extra == 0)
+    print(f'{len(hosts)} hosts, {in_sync} in sync with the package file')
+
+    for label, host_counts in [ ('missing from', missing_hosts), ('not in the package file on', extra_hosts) ]:
+        drifting = sorted((index for index, count in enumerate(host_counts) if count > 0), key=lambda x: (-host_counts[x], names[x]))
+
+        if len(drifting) > 0:
+            print()
+            print(f'Most commonly {label}:')
+
+            for index in drifting[:FLEET_DIFF_TOP]:
+                print(f'{names[index]:<40}{host_counts[index]:>10} hosts')
+
+def deps(package_name: str | None):
+    if not os.path.isdir(LOCAL_DB_LOC):
+        raise FileNotFoundError(f'Local package database not found at {LOCAL_DB_LOC}')
+
+    graph = build_dependency_graph(get_local_packages())
+
+    if package_name is not None:
+        if package_name not in graph.packages:
+            raise FileNotFoundError(f'Package {package_name} is not installed')
+
+        closure = graph.closure([ package_name ])
+        for name in sorted(closure):
+            print(f'{name:<40}{graph.packages[name].size / 1024 ** 2:>10.1f} MiB')
+
+        print(f'{len(closure)} packages, {graph.footprint(closure) / 1024 ** 2:.1f} MiB in total')
+
+        for label, reverse_edges in [ ('Required by', graph.required_by), ('Optional for', graph.optional_for) ]:
+            if len(reverse_edges[package_name]) > 0:
+                print(f'{label}: {", ".join(sorted(reverse_edges[package_name]))}')
+
+        return
+
+    listfile_packages = sorted(package.name for package in get_listfile_packages(LISTFILE) if package.name in graph.packages)
+
+    print(f'{"PACKAGE":<40}{"PACKAGES":>10}{"FOOTPRINT [MiB]":>17}')
+    for name in listfile_packages:
+        closure = graph.closure([ name ])
+
+        print(f'{name:<40}{len(closure):>10}{graph.footprint(closure) / 1024 ** 2:>17.1f}')
+
+    declared_closure = graph.closure(listfile_packages)
+    print(f'{"(all declared)":<40}{len(declared_closure):>10}{graph.footprint(declared_closure) / 1024 ** 2:>17.1f}')
+
 def edit():
     subprocess.run([os.environ['EDITOR'], LISTFILE])
 
@@ -175,16 +914,39 @@ def help():
     print('Usage: sysman package COMMAND')
     print()
     print('Available COMMANDs:')
-    print(f'{"help":<20}Prints this message.')
-    print(f'{"sync":<20}Syncs system packages with the package file.')
-    print(f'{"edit":<20}Opens the package file in $EDITOR.')
+    print(f'{"help":<40}Prints this message.')
+    print(f'{"sync":<40}Syncs system packages with the package file. PKGBUILDs of AUR packages are shown for review before they are built.')
+    print(f'{"sync --plan [--unlisted] [--orphans]":<40}Prints the changes sync would make as JSON, without making them. Packages missing from the package file and orphaned dependencies are listed under unlisted and orphans, they are planned for removal only if --unlisted or --orphans is given.')
+    print(f'{"sync --apply PLAN [--allow-aur]":<40}Makes the changes from a PLAN file without asking. Packages from the AUR are built and installed only if --allow-aur is given, their PKGBUILDs are not shown for review.')
+    print(f'{"edit":<40}Opens the package file in $EDITOR.')
+    print(f'{"fleet-diff LISTFILE DIR":<40}Compares the package file LISTFILE with every host snapshot in DIR, either pacman -Qqe output or a copy of the local package database.')
+    print(f'{"deps [PACKAGE]":<40}Prints dependencies, disk footprint and dependent packages of PACKAGE, or of every package in the package file if PACKAGE is not given.')
 
 def main(args: list[str]):
-    if len(args) != 1 or args[0] not in [ 'sync', 'edit' ]:
+    is_plan = args[:2] == [ 'sync', '--plan' ] and all(arg in [ '--unlisted', '--orphans' ] for arg in args[2:]) and len(set(args[2:])) == len(args[2:])
+
+    if len(args) == 0\
+    or (len(args) == 1 and args[0] not in [ 'sync', 'edit', 'deps' ])\
+    or (len(args) == 2 and args[0] not in [ 'deps' ] and not is_plan)\
+    or (len(args) == 3 and args[:2] != [ 'sync', '--apply' ] and args[0] != 'fleet-diff' and not is_plan)\
+    or (len(args) == 4 and not is_plan and (args[:2] != [ 'sync', '--apply' ] or args[3] != '--allow-aur'))\
+    or len(args) > 4:
         help()
 
+    elif is_plan:
+        print(json.dumps(plan('--unlisted' in args, '--orphans' in args), indent=4))
+
+    elif args[:2] == [ 'sync', '--apply' ]:
+        apply(args[2], len(args) == 4)
+
     elif args[0] == 'sync':
         sync()
     
     elif args[0] == 'edit':
         edit()
+
+    elif args[0] == 'fleet-diff':
+        fleet_diff(args[1], args[2])
+
+    elif args[0] == 'deps':
+        deps(args[1] if len(args) == 2 else None)
@@ -11,6 +11,27 @@ from dataclasses import dataclass, is_dataclass, fields, asdict
 SERVICEFILE_DIR = f'{os.environ["HOME"]}/.config/sysman'
 SERVICEFILE = f'{SERVICEFILE_DIR}/services.json'
 SERVICEFILE_OLD = f'{SERVICEFILE_DIR}/tmp/services.json.old'
+UNIT_SEARCH_PATHS = { # in the order systemd looks for unit files
+    'system': [
+        '/etc/systemd/system',
+        '/run/systemd/system',
+        '/usr/local/lib/systemd/system',
+        '/usr/lib/systemd/system'
+    ],
+    'user': [
+        f'{os.environ["HOME"]}/.config/systemd/user',
+        '/etc/systemd/user',
+        '/run/systemd/user',
+        f'{os.environ["HOME"]}/.local/share/systemd/user',
+        '/usr/local/lib/systemd/user',
+        '/usr/lib/systemd/user'
+    ]
+}
+UNIT_CONFIG_PATHS = { # where systemctl enable and mask create their symlinks
+    'system': [ '/etc/systemd/system' ],
+    'user': [ f'{os.environ["HOME"]}/.config/systemd/user', '/etc/systemd/user' ]
+}
+UNIT_SUFFIXES = ( '.service', '.socket', '.timer', '.path', '.mount', '.automount', '.swap', '.target', '.device', '.slice', '.scope' )
 
 
 @dataclass
@@ -96,55 +117,166 @@ def read_file_to_servicefile(path: str) -> ServiceFile:
 
     return services
 
+unit_dir_cache: dict[str, tuple[int, dict[str, str | None]]] = {}
+
+
+def list_unit_dir(directory: str) -> dict[str, str | None]:
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+
+    except OSError:
+        return {}
+
+    cached = unit_dir_cache.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    # entry name -> symlink target, None for regular files and directories
+    entries = {}
+    with os.scandir(directory) as scanned_entries:
+        for entry in scanned_entries:
+            entries[entry.name] = os.readlink(entry.path) if entry.is_symlink() else None
+
+    unit_dir_cache[directory] = (mtime, entries)
+
+    return entries
+
+def unit_file_name(name: str) -> str:
+    return name if name.endswith(UNIT_SUFFIXES) else f'{name}.service'
+
+def find_unit_file(unit: str, svc_type: str) -> str | None:
+    candidates = [ unit ]
+    if '@' in unit: # instance of a template
+        prefix, _, suffix = unit.partition('@')
+        candidates.append(f'{prefix}@{suffix[suffix.rindex("."):]}')
+
+    for candidate in candidates:
+        for search_path in UNIT_SEARCH_PATHS[svc_type]:
+            if candidate in list_unit_dir(search_path):
+                return f'{search_path}/{candidate}'
+
+    return None
+
+def read_install_section(path: str) -> dict[str, list[str]]:
+    install = {}
+    section = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+
+            if line.startswith('['):
+                section = line
+
+            elif section == '[Install]' and '=' in line and not line.startswith(('#', ';')):
+                key, value = line.split('=', 1)
+                install.setdefault(key.strip(), []).extend(value.split())
+
+    return install
+
+def is_linked_in_config(unit: str, svc_type: str) -> bool:
+    for config_path in UNIT_CONFIG_PATHS[svc_type]:
+        entries = list_unit_dir(config_path)
+
+        for name, target in entries.items():
+            if name.endswith(('.wants', '.requires', '.upholds')) and target is None:
+                if unit in list_unit_dir(f'{config_path}/{name}'):
+                    return True
+
+            elif target is not None and name != unit and os.path.basename(target) == unit: # alias
+                return True
+
+    return False
+
+def resolve_unit_state(name: str, svc_type: str) -> str | None:
+    # None when the state cannot be told from the unit files alone
+    if not any(os.path.isdir(search_path) for search_path in UNIT_SEARCH_PATHS[svc_type]):
+        return None
+
+    unit = unit_file_name(name)
+
+    for config_path in UNIT_CONFIG_PATHS[svc_type]:
+        target = list_unit_dir(config_path).get(unit)
+
+        if target == '/dev/null':
+            return 'masked'
+
+        if target is not None: # linked from outside the search paths, or an alias
+            return None
+
+    unit_path = find_unit_file(unit, svc_type)
+
+    if unit_path is None: # generated, transient or runtime units live outside the search paths, systemctl confirms
+        return None
+
+    if os.path.islink(unit_path) or unit.endswith(f'@{unit[unit.rindex("."):]}'): # vendor alias or bare template
+        return None
+
+    if is_linked_in_config(unit, svc_type):
+        return 'enabled'
+
+    install = read_install_section(unit_path)
+
+    if any(len(install.get(key, [])) > 0 for key in [ 'WantedBy', 'RequiredBy', 'UpheldBy', 'Alias' ]):
+        return 'disabled'
+
+    if len(install.get('Also', [])) > 0: # indirect
+        return None
+
+    return 'static'
+
+def query_unit_state(name: str, svc_type: str) -> str:
+    output = subprocess.run(
+        [ 'systemctl', *([ '--user' ] if svc_type == 'user' else []), 'is-enabled', name ],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    ).stdout.strip()
+
+    return output if output != '' else 'not-found'
+
 def get_states_of_services(queried_services: list[Service]) -> list[tuple[Service, str]]:
-    system_services = [ svc for svc in queried_services if svc.svc_type == 'system' ]
-    user_services = [ svc for svc in queried_services if svc.svc_type == 'user' ]
-
-    if len(system_services) > 0:
-        system_services_states = subprocess.run([
-            'sudo',
-            'systemctl',
-            'is-enabled',
-            *[ svc.name for svc in system_services ]], stdout=subprocess.PIPE, text=True).stdout.split('\n')[:-1]
-    else:
-        system_services_states = []
-
-    if len(user_services) > 0:
-        user_services_states = subprocess.run([
-            'systemctl',
-            '--user',
-            'is-enabled',
-            *[ svc.name for svc in user_services ]], stdout=subprocess.PIPE, text=True).stdout.split('\n')[:-1]
-    else:
-        user_services_states = []
+    services_states = []
+    for svc in queried_services:
+        state = resolve_unit_state(svc.name, svc.svc_type)
 
-    services_states = zip(system_services + user_services, system_services_states + user_services_states)
+        # systemctl prints nothing for unknown units, so it is asked about one unit at a time to keep states paired with services
+        services_states.append((svc, state if state is not None else query_unit_state(svc.name, svc.svc_type)))
 
-    return list(services_states)
+    return services_states
 
-def enable_system_service(svc: Service):
-    subprocess.run(['sudo', 'systemctl', 'enable', '--now', svc.name])
+def systemctl_command(svc_type: str) -> list[str]:
+    return [ 'sudo', 'systemctl' ] if svc_type == 'system' else [ 'systemctl', '--user' ]
 
-def enable_user_service(svc: Service):
-    subprocess.run(['systemctl', '--user', 'enable', '--now', svc.name])
+def run_per_scope(services: list[Service], action: list[str]) -> list[Service]:
+    # one call per scope, systemctl applies nothing if any unit fails, so the units are then retried one at a time
+    failed_services = []
+    for svc_type in [ 'system', 'user' ]:
+        scope_services = [ svc for svc in services if svc.svc_type == svc_type ]
 
-def enable_service(svc: Service):
-    if svc.svc_type == 'system':
-        enable_system_service(svc)
-    else:
-        enable_user_service(svc)
+        if len(scope_services) == 0:
+            continue
 
-def disable_system_service(svc: Service):
-    subprocess.run(['sudo', 'systemctl', 'disable', svc.name])
+        if subprocess.run([ *systemctl_command(svc_type), *action, *[ svc.name for svc in scope_services ] ]).returncode != 0:
+            failed_services.extend(
+                svc for svc in scope_services
+                if subprocess.run([ *systemctl_command(svc_type), *action, svc.name ]).returncode != 0
+            )
 
-def disable_user_service(svc: Service):
-    subprocess.run(['systemctl', '--user', 'disable', svc.name])
+    return failed_services
 
-def disable_service(svc: Service):
-    if svc.svc_type == 'system':
-        disable_system_service(svc)
-    else:
-        disable_user_service(svc)
+def enable_services(services: list[Service]) -> list[Service]:
+    # the daemon is reloaded separately once unit files are in place
+    return run_per_scope(services, [ 'enable', '--now', '--no-reload' ])
+
+def disable_services(services: list[Service]) -> list[Service]:
+    return run_per_scope(services, [ 'disable', '--no-reload' ])
+
+def raise_if_failed(failed_services: list[Service], action: str):
+    if len(failed_services) > 0:
+        raise ChildProcessError(f'Could not {action} services {", ".join(f"{svc.name} ({svc.svc_type})" for svc in failed_services)}.')
+
+def reload_daemons(svc_types: set[str]):
+    for svc_type in [ 'system', 'user' ]:
+        if svc_type in svc_types:
+            subprocess.run([ *systemctl_command(svc_type), 'daemon-reload' ])
 
 def sudo_copy(src: str, dst: str):
     expanded_src = os.path.expanduser(src)
@@ -274,6 +406,8 @@ def sync():
         raise FileNotFoundError(f"Service file doesn't exists at {SERVICEFILE}. Generate it using sysman service generate.")
 
     services = read_file_to_servicefile(SERVICEFILE)
+    changed_scopes = set()
+    failed_disables = []
 
     # 1. deactivate activated services from services.old
     if os.path.isfile(SERVICEFILE_OLD):
@@ -285,33 +419,27 @@ def sync():
 
         services_old_states = get_states_of_services(services_old_to_remove)
 
-        active_services_old = filter(lambda o: type(o[0]) is Service and o[1] != 'disabled', services_old_states)
-        for svc in active_services_old:
-            service = svc[0]
-            state = svc[1]
-
-            if state == 'enabled':
-                disable_service(service)
+        failed_disables = disable_services([ service for service, state in services_old_states if state == 'enabled' ])
 
-        active_services_old_local = filter(lambda o: type(o[0]) is LocalService and o[1] != 'not-found', services_old_states)
-        for svc in active_services_old_local:
-            service = svc[0]
-            state = svc[1]
+        for service, state in services_old_states:
+            if type(service) is LocalService and state != 'not-found':
+                uninstall_service_file(service)
+                uninstall_service_script(service)
 
-            if state == 'enabled':
-                disable_service(service)
+                changed_scopes.add(service.svc_type)
 
-            uninstall_service_file(service)
-            uninstall_service_script(service)
+            elif state == 'enabled':
+                changed_scopes.add(service.svc_type)
 
     # 2. activate inactive services
     services_states = get_states_of_services(services.get_all_services() + services.get_all_local_services())
-    inactive_services = filter(lambda o: o[1] != 'enabled', services_states)
+    inactive_services = [ (service, state) for service, state in services_states if state not in [ 'enabled', 'masked' ] ]
 
-    for svc in inactive_services:
-        service = svc[0]
-        state = svc[1]
+    masked_services = [ service.name for service, state in services_states if state == 'masked' ]
+    if len(masked_services) > 0:
+        print(f'Services {", ".join(masked_services)} are masked, unmask them to enable them.')
 
+    for service, state in inactive_services:
         if state == 'not-found':
             if type(service) is Service:
                 raise FileNotFoundError(f'Service {service.name} does not exist')
@@ -319,7 +447,14 @@ def sync():
             install_service_script(service)
             install_service_file(service)
 
-        enable_service(service)
+        changed_scopes.add(service.svc_type)
+
+    reload_daemons(changed_scopes)
+    failed_enables = enable_services([ service for service, _ in inactive_services ])
+
+    # the service file is not marked as synced, the next sync tries again
+    raise_if_failed(failed_disables, 'disable')
+    raise_if_failed(failed_enables, 'enable')
 
     # 3. overwrite servicefile.old
     if os.path.isfile(SERVICEFILE_OLD):
@@ -355,7 +490,7 @@ def reinstall(service_name: str):
     state = svc[1]
 
     if state == 'enabled':
-        disable_service(service)
+        raise_if_failed(disable_services([ service ]), 'disable')
 
     if type(service) is LocalService:
         uninstall_service_file(service_old)
@@ -364,7 +499,9 @@ def reinstall(service_name: str):
         install_service_script(service)
         install_service_file(service)
 
-    enable_service(service)
+        reload_daemons({ service.svc_type })
+
+    raise_if_failed(enable_services([ service ]), 'enable')
 
     os.remove(SERVICEFILE_OLD)
     shutil.copy2(SERVICEFILE, SERVICEFILE_OLD)
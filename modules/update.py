@@ -1,30 +1,62 @@
 _name = 'update'
 _desc = 'Update the system or rollback previous update.'
 
+import bz2
 import collections
+import concurrent.futures
+import contextlib
+import csv
 import datetime
-import glob
+import gzip
+import io
 import json
+import lzma
+import math
 import os
 import pathlib
+import resource
+import shutil
+import signal
+import sqlite3
+import statistics
 import subprocess
-from dataclasses import dataclass, asdict
+import sys
+import time
+from dataclasses import dataclass, asdict, field
+from typing import Iterable, Iterator
 
 
 CONFIG_DIR = f'{os.environ["HOME"]}/.config/sysman'
 PIPELINE_FILE = f'{CONFIG_DIR}/update_pipeline.json'
 TIMESTAMP_FILE = f'{CONFIG_DIR}/tmp/timestamp'
+ALPM_INDEX_FILE = f'{CONFIG_DIR}/tmp/alpm_index.sqlite'
+ALPM_INDEX_VERSION = 2
+CACHE_INDEX_FILE = f'{CONFIG_DIR}/tmp/cache_index.json'
+GENERATIONS_FILE = f'{CONFIG_DIR}/tmp/generations.json'
+STEP_HISTORY_FILE = f'{CONFIG_DIR}/tmp/step_history.csv'
 PACMAN_LOG = '/var/log/pacman.log'
 PACMAN_CACHE_LOC = '/var/cache/pacman/pkg'
 CACHE_DIR = f'{os.getenv("HOME")}/.cache'
 AUR_CACHE_LOC = f'{CACHE_DIR}/yay'
 AUR_REBUILD_CACHE_LOC = f'{CACHE_DIR}/yay-rebuild'
+AUR_BUILD_CACHE_LOC = f'{CACHE_DIR}/sysman/aur' # packages built by sysman package sync
+CACHE_ROOTS = [ (PACMAN_CACHE_LOC, 0), (AUR_CACHE_LOC, 1), (AUR_BUILD_CACHE_LOC, 1), (AUR_REBUILD_CACHE_LOC, None) ] # (root, max depth of package files)
+PIPELINE_WORKERS = 4 # maximum number of pipeline steps running at the same time
+VERIFY_WORKERS = os.cpu_count() or 4 # cached packages verified at the same time before rollback
+MAX_GENERATIONS = 10 # number of latest updates that can be rolled back
+STATS_TREND_RUNS = 5 # number of latest runs compared against older ones in stats
+ARG_POINTER_SIZE = 8 # argv and envp entries also take a pointer each
+ARG_MAX_MARGIN = 4096 # room for variables added by sudo
+ALPM_OPERATIONS = [ 'installed', 'upgraded', 'removed', 'reinstalled' ]
+PACKAGE_COMPRESSIONS = [ '', '.zst', '.xz', '.gz', '.bz2', '.lzo', '.lrz', '.lz4', '.lz', '.Z' ] # what makepkg can produce after .pkg.tar
 
 
 @dataclass
 class UpdateStep:
     command: str
     special_env: str
+    id: str | None = None
+    needs: list[str] | None = None
 
 
 @dataclass
@@ -38,6 +70,79 @@ class UpdatePipelines:
     pipelines: list[UpdatePipeline]
 
 
+@dataclass
+class PipelineStep:
+    id: str
+    needs: list[str]
+    command: list[str]
+    env: dict[str, str] | None
+
+
+@dataclass
+class CommandUsage:
+    wall_time: float
+    cpu_time: float
+    max_rss: int
+    exit_status: int
+    failed_cmd: list[str] | None
+
+
+@dataclass
+class StepRecord:
+    timestamp: str
+    pipeline: str
+    step: str
+    command: str
+    wall_time: float
+    cpu_time: float
+    max_rss: int
+    exit_status: int
+
+
+@dataclass
+class LogOperation:
+    time: datetime.datetime
+    operation: str
+    package: str
+    old_version: str | None
+    new_version: str | None
+    offset: int
+
+
+@dataclass
+class RollbackPlan:
+    upgrades: list[tuple[str, str]]
+    installs: list[tuple[str, str]]
+    removals: list[tuple[str, str]]
+    reinstalls: list[tuple[str, str]]
+
+
+@dataclass
+class PrecomputedRollback:
+    timestamp: str
+    log_inode: int
+    log_size: int
+    cache_files: list[str]
+    rollback_process: list[list[list[str], dict[str, str]]]
+    cache_misses: list[list[str]] = field(default_factory=list)
+
+
+@dataclass
+class Generation:
+    timestamp: str
+    log_inode: int | None
+    log_offset: int | None
+    rebuild_cache: str
+    rollback: PrecomputedRollback | None
+
+
+@dataclass
+class CacheDirectory:
+    mtime: int
+    files: list[str]
+    subdirs: list[str]
+
+
 class CustomJsonEncoder(json.JSONEncoder):
     def default(self, o):
         if type(o) is UpdatePipelines:
@@ -50,7 +155,7 @@ class CustomJsonEncoder(json.JSONEncoder):
             return [ self.default(i) for i in o ]
 
         if type(o) is UpdateStep:
-            obj_dict = asdict(o)
+            obj_dict = { k: v for k, v in asdict(o).items() if v is not None }
 
             return f'##<{obj_dict}>##'
 
@@ -63,16 +168,19 @@ def read_timestamp() -> datetime.datetime:
 
     return timestamp
 
+def current_timestamp() -> str:
+    return datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()
+
 def write_timestamp(timestamp: str | None = None) -> str:
     with open(TIMESTAMP_FILE, 'w+') as f:
         if timestamp is None:
-            timestamp = datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()
+            timestamp = current_timestamp()
 
         f.write(timestamp)
 
     return timestamp
 
-def read_update_pipeline_file(timestamp: str, pipeline_name: str | None) -> list[UpdateStep]:
+def read_update_pipeline_file(timestamp: str, pipeline_name: str | None) -> tuple[str, list[PipelineStep]]:
     with open(PIPELINE_FILE, 'r') as f:
         file_content = json.load(f)
 
@@ -82,7 +190,7 @@ def read_update_pipeline_file(timestamp: str, pipeline_name: str | None) -> list
     pipeline = file_content[pipeline_name]
 
     update_pipeline = []
-    for step in pipeline:
+    for i, step in enumerate(pipeline):
         cmd = step['command'].split(' ')
 
         special_env = step['special_env']
@@ -92,132 +200,711 @@ def read_update_pipeline_file(timestamp: str, pipeline_name: str | None) -> list
         else:
             env = None
 
-        update_pipeline.append([ cmd, env ])
-    
-    return update_pipeline
+        step_id = step.get('id', str(i))
+        needs = step.get('needs', [ update_pipeline[-1].id ] if i > 0 else []) # without needs, wait for the previous step
+
+        update_pipeline.append(PipelineStep(step_id, needs, cmd, env))
+
+    validate_pipeline(update_pipeline)
+
+    return pipeline_name, update_pipeline
+
+def validate_pipeline(steps: list[PipelineStep]) -> None:
+    ids = [ step.id for step in steps ]
+    if len(set(ids)) != len(ids):
+        raise ValueError('Step ids in the update pipeline must be unique')
+
+    for step in steps:
+        for need in step.needs:
+            if need not in ids:
+                raise ValueError(f'Step {step.id} needs step {need}, which is not defined in the update pipeline')
+
+    ordered = topological_order(steps)
+    if len(ordered) != len(steps):
+        raise ValueError('Steps in the update pipeline have circular needs')
+
+def pipeline_graph(steps: list[PipelineStep]) -> tuple[dict[str, int], dict[str, list[PipelineStep]]]:
+    remaining = { step.id: len(step.needs) for step in steps }
+    dependents = collections.defaultdict(list)
+    for step in steps:
+        for need in step.needs:
+            dependents[need].append(step)
+
+    return remaining, dependents
+
+def topological_order(steps: list[PipelineStep]) -> list[PipelineStep]:
+    remaining, dependents = pipeline_graph(steps)
 
+    ready = collections.deque(step for step in steps if remaining[step.id] == 0)
+    ordered = []
+    while ready:
+        step = ready.popleft()
+        ordered.append(step)
 
-def is_date(string: str) -> bool:
+        for dependent in dependents[step.id]:
+            remaining[dependent.id] -= 1
+
+            if remaining[dependent.id] == 0:
+                ready.append(dependent)
+
+    return ordered
+
+def run_pipeline(steps: list[PipelineStep]) -> dict[str, CommandUsage]:
+    remaining, dependents = pipeline_graph(steps)
+
+    ready = collections.deque(step for step in steps if remaining[step.id] == 0)
+    running = {}
+    usages = {}
+
+    with concurrent.futures.ThreadPoolExecutor(PIPELINE_WORKERS) as executor:
+        while ready or running:
+            while ready:
+                step = ready.popleft()
+                running[executor.submit(run_piped, split_pipes(step.command), step.env)] = step
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                usages[step.id] = future.result()
+
+                if usages[step.id].failed_cmd is not None: # steps depending on the failed one are never started
+                    continue
+
+                for dependent in dependents[step.id]:
+                    remaining[dependent.id] -= 1
+
+                    if remaining[dependent.id] == 0:
+                        ready.append(dependent)
+
+    return usages
+
+def append_step_history(timestamp: str, pipeline_name: str, steps: list[PipelineStep], usages: dict[str, CommandUsage]) -> None:
+    with open(STEP_HISTORY_FILE, 'a', newline='') as f:
+        writer = csv.writer(f)
+
+        for step in steps:
+            if step.id not in usages:
+                continue
+
+            usage = usages[step.id]
+            writer.writerow([
+                timestamp,
+                pipeline_name,
+                step.id,
+                ' '.join(step.command),
+                f'{usage.wall_time:.3f}',
+                f'{usage.cpu_time:.3f}',
+                usage.max_rss,
+                usage.exit_status
+            ])
+
+def read_step_history() -> list[StepRecord]:
+    if not os.path.isfile(STEP_HISTORY_FILE):
+        return []
+
+    with open(STEP_HISTORY_FILE, 'r', newline='') as f:
+        return [
+            StepRecord(row[0], row[1], row[2], row[3], float(row[4]), float(row[5]), int(row[6]), int(row[7]))
+            for row in csv.reader(f)
+            if len(row) == 8
+        ]
+
+def parse_log_time(string: str) -> datetime.datetime | None:
     try:
-        datetime.datetime.fromisoformat(string)
-        return True
+        time = datetime.datetime.fromisoformat(string)
 
     except ValueError:
-        return False
+        return None
+
+    if time.tzinfo is None: # old pacman versions logged local time without offset
+        time = time.astimezone()
+
+    return time
+
+def parse_log_line(line: str, offset: int) -> LogOperation | None:
+    if not line.startswith('['):
+        return None
+
+    parts = line.rstrip('\n').split('] ', 2)
+    if len(parts) != 3 or parts[1] != '[ALPM':
+        return None
+
+    message = parts[2].split(' ', 2)
+    if len(message) != 3 or message[0] not in ALPM_OPERATIONS:
+        return None
+
+    time = parse_log_time(parts[0][1:])
+    if time is None:
+        return None
+
+    operation, package, version = message[0], message[1], message[2][1:-1]
+
+    if operation == 'upgraded':
+        old_version, _, new_version = version.partition(' -> ')
+
+    elif operation == 'installed':
+        old_version, new_version = None, version
+
+    elif operation == 'removed':
+        old_version, new_version = version, None
+
+    else: # reinstalled
+        old_version, new_version = version, version
+
+    return LogOperation(time, operation, package, old_version, new_version, offset)
+
+def seek_line(f: io.BufferedReader, offset: int) -> None:
+    # move to the start of the first line beginning at or after offset
+    f.seek(max(offset - 1, 0))
+    if offset > 0:
+        f.readline()
+
+def read_first_time(f: io.BufferedIOBase) -> datetime.datetime | None:
+    # time of the first timestamped line from the current position
+    for line in f:
+        if line.startswith(b'['):
+            time = parse_log_time(line[1:line.find(b']')].decode(errors='replace'))
+
+            if time is not None:
+                return time
+
+    return None
+
+def read_line_time(f: io.BufferedReader, offset: int) -> datetime.datetime | None:
+    seek_line(f, offset)
+
+    return read_first_time(f)
+
+def find_log_offset(f: io.BufferedReader, since: datetime.datetime) -> int:
+    lo, hi = 0, f.seek(0, os.SEEK_END)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        time = read_line_time(f, mid)
 
-def search_cache(pkgs: list[str, str], pacman_cache: list[str], aur_cache: list[str]) -> list[str]:
+        if time is None or time >= since:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return lo
+
+def read_log_operations(f: io.BufferedIOBase, offset: int) -> Iterator[LogOperation]:
+    for line in f:
+        operation = parse_log_line(line.decode(errors='replace'), offset)
+        offset += len(line)
+
+        if operation is not None:
+            yield operation
+
+def read_pacman_log(path: str, since: datetime.datetime, inode: int | None = None, offset: int | None = None) -> Iterator[LogOperation]:
+    with open(path, 'rb') as f:
+        log_stat = os.fstat(f.fileno())
+
+        if inode == log_stat.st_ino and offset is not None and offset <= log_stat.st_size: # position recorded when the update started
+            seek_line(f, offset)
+        else:
+            seek_line(f, find_log_offset(f, since))
+
+        for operation in read_log_operations(f, f.tell()):
+            if operation.time >= since:
+                yield operation
+
+@contextlib.contextmanager
+def open_log(path: str) -> Iterator[io.BufferedIOBase]:
+    if path.endswith('.zst'):
+        process = subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE)
+
+        try:
+            yield process.stdout
+
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    else:
+        opener = { '.gz': gzip.open, '.xz': lzma.open, '.bz2': bz2.open }.get(os.path.splitext(path)[1], open)
+
+        with opener(path, 'rb') as f:
+            yield f
+
+def first_log_time(path: str) -> datetime.datetime | None:
+    with open_log(path) as f:
+        return read_first_time(f)
+
+def find_rotated_logs(path: str) -> list[str]:
+    # pacman.log.1, pacman.log.2.gz, pacman.log-20240101.zst, ... newest first
+    directory, name = os.path.split(path)
+
+    rotated_logs = [
+        f'{directory}/{file}'
+        for file in os.listdir(directory)
+        if file.startswith(f'{name}.') or file.startswith(f'{name}-')
+    ]
+
+    return sorted(rotated_logs, key=lambda file: os.stat(file).st_mtime, reverse=True)
+
+def read_rotated_logs(path: str, since: datetime.datetime, until: datetime.datetime) -> list[LogOperation]:
+    chunks = []
+    for rotated_log in find_rotated_logs(path):
+        with open_log(rotated_log) as f:
+            chunks.append([ operation for operation in read_log_operations(f, 0) if since <= operation.time < until ])
+
+        first_time = first_log_time(rotated_log)
+        if first_time is not None and first_time <= since: # older logs only hold older operations
+            break
+
+    return [ operation for chunk in reversed(chunks) for operation in chunk ]
+
+def open_alpm_index() -> sqlite3.Connection:
+    connection = sqlite3.connect(ALPM_INDEX_FILE)
+
+    if connection.execute('PRAGMA user_version').fetchone()[0] != ALPM_INDEX_VERSION: # the index is a cache, rebuild it on format changes
+        connection.executescript('''
+            DROP TABLE IF EXISTS operations;
+            DROP TABLE IF EXISTS log_state;
+        ''')
+        connection.execute(f'PRAGMA user_version = {ALPM_INDEX_VERSION}')
+
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS operations (
+            id INTEGER PRIMARY KEY,
+            time REAL NOT NULL,
+            operation TEXT NOT NULL,
+            package TEXT NOT NULL,
+            old_version TEXT,
+            new_version TEXT,
+            offset INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS operations_time ON operations (time);
+        CREATE INDEX IF NOT EXISTS operations_package ON operations (package);
+        CREATE TABLE IF NOT EXISTS log_state (
+            path TEXT PRIMARY KEY,
+            inode INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            covered_from REAL NOT NULL
+        );
+    ''')
+
+    return connection
+
+def index_log_tail(connection: sqlite3.Connection, log_path: str, offset: int) -> int:
+    def index_rows(f: io.BufferedReader) -> Iterator[tuple]:
+        nonlocal offset
+
+        for line in f:
+            if not line.endswith(b'\n'): # line still being written by pacman
+                break
+
+            op = parse_log_line(line.decode(errors='replace'), offset)
+            offset += len(line)
+
+            if op is not None:
+                yield (op.time.timestamp(), op.operation, op.package, op.old_version, op.new_version, op.offset)
+
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+
+        connection.executemany(
+            'INSERT INTO operations (time, operation, package, old_version, new_version, offset) VALUES (?, ?, ?, ?, ?, ?)',
+            index_rows(f)
+        )
+
+    return offset
+
+def log_start_time(log_path: str) -> float:
+    first_time = first_log_time(log_path)
+
+    return first_time.timestamp() if first_time is not None else time.time()
+
+def update_alpm_index(connection: sqlite3.Connection, log_path: str) -> datetime.datetime:
+    # returns the time since which the index holds every operation, older ones are in rotated logs
+    log_stat = os.stat(log_path)
+
+    state = connection.execute('SELECT inode, offset, covered_from FROM log_state WHERE path = ?', (log_path,)).fetchone()
+    if state is None:
+        offset, covered_from = 0, log_start_time(log_path)
+
+    elif state[0] != log_stat.st_ino or state[1] > log_stat.st_size: # rotated or truncated log
+        previous_log = next((file for file in find_rotated_logs(log_path) if os.stat(file).st_ino == state[0]), None)
+
+        if previous_log is not None: # rotated without compression, finish indexing it
+            index_log_tail(connection, previous_log, state[1])
+            covered_from = state[2]
+        else:
+            covered_from = log_start_time(log_path)
+
+        offset = 0
+
+    else:
+        offset, covered_from = state[1], state[2]
+
+        if offset == log_stat.st_size:
+            return from_index_time(covered_from)
+
+    with connection:
+        offset = index_log_tail(connection, log_path, offset)
+        connection.execute('INSERT OR REPLACE INTO log_state VALUES (?, ?, ?, ?)', (log_path, log_stat.st_ino, offset, covered_from))
+
+    return from_index_time(covered_from)
+
+def from_index_time(index_time: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(index_time, datetime.timezone.utc).astimezone()
+
+def query_alpm_index(connection: sqlite3.Connection, since: datetime.datetime) -> list[LogOperation]:
+    rows = connection.execute(
+        'SELECT time, operation, package, old_version, new_version, offset FROM operations WHERE time >= ? ORDER BY id',
+        (since.timestamp(),)
+    )
+
+    return [ LogOperation(from_index_time(row[0]), *row[1:]) for row in rows ]
+
+def read_operations_since(since: datetime.datetime, inode: int | None = None, offset: int | None = None) -> list[LogOperation]:
+    try:
+        connection = open_alpm_index()
+
+        try:
+            covered_from = update_alpm_index(connection, PACMAN_LOG)
+            operations = query_alpm_index(connection, max(since, covered_from))
+
+        finally:
+            connection.close()
+
+    except sqlite3.Error: # unusable index, read the log directly
+        covered_from = first_log_time(PACMAN_LOG) or since
+        operations = list(read_pacman_log(PACMAN_LOG, since, inode, offset))
+
+    if since < covered_from: # part of the operations was rotated out of the log
+        operations = read_rotated_logs(PACMAN_LOG, since, covered_from) + operations
+
+    return operations
+
+def plan_rollback(operations: Iterable[LogOperation]) -> RollbackPlan:
+    tallier = collections.defaultdict(lambda: 0)
+    upgrades = {}
+    installs = {}
+    removals = {}
+    reinstalls = {}
+
+    for op in operations:
+        if op.operation == 'upgraded':
+            upgrades.setdefault(op.package, op.old_version) # version from before the first upgrade
+
+        elif op.operation == 'installed':
+            tallier[op.package] += 1
+            installs.setdefault(op.package, op.new_version)
+
+        elif op.operation == 'removed':
+            tallier[op.package] -= 1
+            removals.setdefault(op.package, op.old_version)
+
+        elif op.operation == 'reinstalled':
+            reinstalls.setdefault(op.package, op.new_version)
+
+    return RollbackPlan(
+        list(upgrades.items()),
+        [ pkg for pkg in installs.items() if tallier[pkg[0]] > 0 ],
+        [ pkg for pkg in removals.items() if tallier[pkg[0]] < 0 and pkg[0] not in upgrades ],
+        list(reinstalls.items())
+    )
+
+def parse_package_filename(path: str) -> tuple[str, str] | None:
+    filename = os.path.basename(path)
+    stem, separator, extension = filename.partition('.pkg.tar')
+
+    if separator == '' or extension not in PACKAGE_COMPRESSIONS: # signatures, partial downloads
+        return None
+
+    parts = stem.rsplit('-', 3) # name-pkgver-pkgrel-arch
+    if len(parts) != 4:
+        return None
+
+    return parts[0], f'{parts[1]}-{parts[2]}'
+
+def index_cache(cache: list[str]) -> dict[tuple[str, str], str]:
+    cache_index = {}
+    for path in cache:
+        key = parse_package_filename(path)
+
+        if key is not None and key not in cache_index:
+            cache_index[key] = path
+
+    return cache_index
+
+def read_cache_index() -> dict[str, CacheDirectory]:
+    try:
+        with open(CACHE_INDEX_FILE, 'r') as f:
+            cache_index = { path: CacheDirectory(**directory) for path, directory in json.load(f).items() }
+
+    except (OSError, ValueError, TypeError):
+        cache_index = {}
+
+    return cache_index
+
+def write_cache_index(cache_index: dict[str, CacheDirectory]) -> None:
+    tmp_cache_index = f'{CACHE_INDEX_FILE}.{os.getpid()}'
+
+    with open(tmp_cache_index, 'w+') as f:
+        json.dump({ path: asdict(directory) for path, directory in cache_index.items() }, f)
+
+    os.replace(tmp_cache_index, CACHE_INDEX_FILE)
+
+def scan_cache_directory(path: str, depth: int | None, cache_index: dict[str, CacheDirectory], visited: set[str]) -> list[str]:
+    try:
+        mtime = os.stat(path).st_mtime_ns
+
+    except FileNotFoundError:
+        return []
+
+    directory = cache_index.get(path)
+    if directory is None or directory.mtime != mtime:
+        directory = CacheDirectory(mtime, [], [])
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+
+                if entry.is_dir():
+                    directory.subdirs.append(entry.name)
+
+                elif parse_package_filename(entry.name) is not None:
+                    directory.files.append(entry.name)
+
+        cache_index[path] = directory
+
+    visited.add(path)
+
+    packages = [ f'{path}/{file}' for file in directory.files if parse_package_filename(file) is not None ] # indexes written before .part files were rejected
+    if depth is None or depth > 0:
+        for subdir in directory.subdirs:
+            packages += scan_cache_directory(f'{path}/{subdir}', None if depth is None else depth - 1, cache_index, visited)
+
+    return packages
+
+def list_package_cache(root: str, depth: int | None, cache_index: dict[str, CacheDirectory]) -> list[str]:
+    visited = set()
+    packages = scan_cache_directory(root, depth, cache_index, visited)
+
+    vanished = [ path for path in cache_index if (path == root or path.startswith(f'{root}/')) and path not in visited ]
+    for path in vanished:
+        del cache_index[path]
+
+    return packages
+
+def search_cache(pkgs: list[str, str], pacman_cache: dict[tuple[str, str], str], aur_cache: dict[tuple[str, str], str]) -> tuple[list[str], list[list[str]]]:
     cache_hits = []
+    cache_misses = []
     for pkg in pkgs:
-        pacman_hit = [ cache for cache in pacman_cache if f'/{pkg[0]}-{pkg[1]}' in cache ]
-        aur_hit = [ cache for cache in aur_cache if f'/{pkg[0]}-{pkg[1]}' in cache ]
-        cache_hit = f'{pacman_hit[0]}' if len(pacman_hit) > 0 else f'{aur_hit[0]}' if len(aur_hit) > 0 else None
+        key = (pkg[0], pkg[1])
+        cache_hit = pacman_cache.get(key, aur_cache.get(key))
 
         if cache_hit is not None:
             cache_hits.append(cache_hit)
+        else:
+            cache_misses.append(list(key))
+
+    return cache_hits, cache_misses
 
-    return cache_hits
+def package_names(targets: list[str]) -> set[str]:
+    return { (parse_package_filename(target) or (target,))[0] for target in targets }
+
+def coalesce_rollback_blueprint(args: list[list[str], list[str], dict[str, str]]) -> list[list[str], list[str], dict[str, str]]:
+    # neighbouring -U phases become one transaction, unless they touch the same package
+    coalesced = []
+    for arg in args:
+        if len(arg[1]) == 0:
+            continue
+
+        if len(coalesced) > 0\
+        and coalesced[-1][0] == arg[0]\
+        and '-U' in arg[0]\
+        and coalesced[-1][2] == arg[2]\
+        and package_names(coalesced[-1][1]).isdisjoint(package_names(arg[1])):
+            coalesced[-1][1] = coalesced[-1][1] + arg[1]
+
+        else:
+            coalesced.append([ arg[0], list(arg[1]), arg[2] ])
+
+    return coalesced
+
+def argument_size(args: list[str]) -> int:
+    return sum(len(arg.encode()) + 1 + ARG_POINTER_SIZE for arg in args)
+
+def batch_arguments(cmd: list[str], targets: list[str], env: dict[str, str] | None) -> list[list[str]]:
+    environment = [ f'{k}={v}' for k, v in (env if env is not None else os.environ).items() ]
+    limit = os.sysconf('SC_ARG_MAX') - argument_size(environment) - argument_size(cmd) - ARG_MAX_MARGIN
+
+    batches = [ [] ]
+    batch_size = 0
+    for target in targets:
+        target_size = argument_size([ target ])
+
+        if batch_size + target_size > limit and len(batches[-1]) > 0:
+            batches.append([])
+            batch_size = 0
+
+        batches[-1].append(target)
+        batch_size += target_size
+
+    return [ [ *cmd, *batch ] for batch in batches ]
 
 def create_rollback_process(args: list[list[str], list[str], dict[str, str]]) -> list[list[str], dict[str, str]]:
     rollback_process = []
-    for arg in args:
-        if len(arg[1]) > 0:
-            rollback_process.append([ [*arg[0], *arg[1]], arg[2] ])
+    for arg in coalesce_rollback_blueprint(args):
+        for cmd in batch_arguments(arg[0], arg[1], arg[2]):
+            rollback_process.append([ cmd, arg[2] ])
     
     return rollback_process
 
+def split_pipes(cmd: list[str]) -> list[list[str]]:
+    pipes_idx = [ -1 ] + [ i for i, o in enumerate(cmd) if o == '|' ] + [ None ]
+
+    return [ cmd[pipes_idx[i - 1]+1:pipes_idx[i]] for i in range(1, len(pipes_idx)) ]
+
+def run_piped(cmds: list[list[str]], env: dict[str, str] | None) -> CommandUsage:
+    start = time.monotonic()
+
+    processes = []
+    try:
+        for i, cmd in enumerate(cmds):
+            stdin = processes[-1].stdout if len(processes) > 0 else None
+            stdout = subprocess.PIPE if i < len(cmds) - 1 else None
+
+            processes.append(subprocess.Popen(cmd, stdin=stdin, stdout=stdout, env=env))
+
+            if stdin is not None: # only the next command reads from it
+                stdin.close()
+
+    except OSError as e: # e.g. a missing command, fails the step like a shell would with 127
+        for process in processes:
+            process.kill()
+            process.wait()
+
+        print(f'{cmds[len(processes)][0]}: {e.strerror}', file=sys.stderr)
+
+        return CommandUsage(time.monotonic() - start, 0.0, 0, 127, cmds[len(processes)])
+
+    cpu_time, max_rss = 0.0, 0
+    for process in processes:
+        _, status, rusage = os.wait4(process.pid, 0) # rusage of the command and its descendants
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        cpu_time += rusage.ru_utime + rusage.ru_stime
+        max_rss = max(max_rss, rusage.ru_maxrss) # never below the peak of this process at fork, it carries over exec
+
+    usage = CommandUsage(time.monotonic() - start, cpu_time, max_rss, 0, None)
+
+    for i, (cmd, process) in enumerate(zip(cmds, processes)):
+        if process.returncode == -signal.SIGPIPE and i < len(cmds) - 1: # next command stopped reading early
+            continue
+
+        if process.returncode != 0:
+            usage.exit_status, usage.failed_cmd = process.returncode, cmd
+
+            break
+
+    return usage
+
 def subprocess_run_sync(args: list[list[str], dict[str, str]]):
     for arg in args:
-        pipes_idx = [ -1 ] + [ i for i, o in enumerate(arg[0]) if o == '|' ] + [ None ]
+        usage = run_piped(split_pipes(arg[0]), arg[1])
 
-        ret = None
-        for i in range(1, len(pipes_idx)):
-            cmd = arg[0][pipes_idx[i - 1]+1:pipes_idx[i]]
+        if usage.failed_cmd is not None:
+            raise subprocess.CalledProcessError(usage.exit_status, usage.failed_cmd)
+
+def read_generations() -> list[Generation]:
+    if not os.path.isfile(GENERATIONS_FILE):
+        return []
+
+    with open(GENERATIONS_FILE, 'r') as f:
+        generations = json.load(f)
+
+    return [
+        Generation(**{ **generation, 'rollback': PrecomputedRollback(**generation['rollback']) if generation['rollback'] is not None else None })
+        for generation in generations
+    ]
 
-            if ret is None and pipes_idx[i] is None: # no pipes
-                subprocess_args = { 'env': arg[1], 'check': True }
+def write_generations(generations: list[Generation]) -> None:
+    tmp_generations = f'{GENERATIONS_FILE}.{os.getpid()}'
 
-            elif ret is None: # pipes but first command
-                subprocess_args = { 'env': arg[1], 'check': True, 'capture_output': True }
-            
-            elif pipes_idx[i] is not None: # pipes but not last command
-                subprocess_args = { 'env': arg[1], 'check': True, 'input': ret.stdout, 'capture_output': True }
-            
-            else: # pipes and last command
-                subprocess_args = { 'env': arg[1], 'check': True, 'input': ret.stdout }
+    with open(tmp_generations, 'w+') as f:
+        json.dump([ asdict(generation) for generation in generations[-MAX_GENERATIONS:] ], f)
 
-            ret = subprocess.run(cmd, **subprocess_args)
+    os.replace(tmp_generations, GENERATIONS_FILE)
+
+def create_generation(timestamp: str) -> Generation:
+    try:
+        log_stat = os.stat(PACMAN_LOG)
+        log_inode, log_offset = log_stat.st_ino, log_stat.st_size
+
+    except FileNotFoundError:
+        log_inode, log_offset = None, None
+
+    return Generation(timestamp, log_inode, log_offset, f'{AUR_REBUILD_CACHE_LOC}/{timestamp}', None)
+
+def restore_update_state(old_timestamp: datetime.datetime, generations: list[Generation], had_generations_file: bool) -> None:
+    write_timestamp(old_timestamp.isoformat())
+
+    if had_generations_file:
+        write_generations(generations)
+
+    else: # keep the fallback to the timestamp of an update that ran before generations were kept
+        os.remove(GENERATIONS_FILE)
 
 def update_system(pipeline_name: str | None):
     old_timestamp = read_timestamp()
-    timestamp = write_timestamp()
+    timestamp = current_timestamp()
+
+    # a pipeline file that does not parse or validate leaves no trace
+    pipeline_name, update_pipeline = read_update_pipeline_file(timestamp, pipeline_name)
+
+    generations = read_generations()
+    generation = create_generation(timestamp)
+    had_generations_file = os.path.isfile(GENERATIONS_FILE)
 
-    update_pipeline = read_update_pipeline_file(timestamp, pipeline_name)
+    write_timestamp(timestamp)
+    write_generations(generations + [ generation ])
 
     try:
-        subprocess_run_sync(update_pipeline)
+        usages = run_pipeline(update_pipeline)
+        append_step_history(timestamp, pipeline_name, update_pipeline, usages)
 
-    except subprocess.CalledProcessError:
-        write_timestamp(old_timestamp.isoformat())
+    except BaseException: # also on Ctrl+C, the update did not happen as planned
+        restore_update_state(old_timestamp, generations, had_generations_file)
 
-def rollback_update():
-    if not os.path.isfile(TIMESTAMP_FILE):
-        raise FileNotFoundError('No update performed on this system yet')
+        raise
 
-    timestamp = read_timestamp()
-
-    with open(PACMAN_LOG, 'r') as f:
-        operations = [
-            [
-                datetime.datetime.fromisoformat(log.split(']')[0][1:]), # time 0
-                log.split(']')[2][1:].split(' ')[0], # operation 1
-                log.split(']')[2][1:].split(' ')[1], # package name 2
-                log.split(']')[2][1:].split('(')[1][:-2] # version 3
-            ]
-            for log in f.readlines()
-            if is_date(log.split(']')[0][1:])
-                and log.split(']')[1][2:] == 'ALPM'
-                and log.split(']')[2][1:].split(' ')[0] in ['installed', 'upgraded', 'removed', 'reinstalled']
-                and datetime.datetime.fromisoformat(log.split(']')[0][1:]) >= timestamp
-        ]
+    if any(usage.failed_cmd is not None for usage in usages.values()):
+        restore_update_state(old_timestamp, generations, had_generations_file)
 
-    inst_and_rem = [ [line[2], line[3], line[1]] for line in operations if line[1] in ['installed', 'removed'] ]
-    tallier = collections.defaultdict(lambda: 0)    
-    for pkg in inst_and_rem:
-        if pkg[2] == 'installed':
-            tallier[pkg[0]] += 1
-        else:
-            tallier[pkg[0]] -= 1
+        return
 
-    upg_names = []
-    upgrades = []
-    for line in operations:
-        if line[1] != 'upgraded' or line[2] in upg_names:
-            continue
-            
-        upgrades.append([line[2], line[3].split(' -> ')[0]])
-        upg_names.append(line[2])
-
-    rem_names = []
-    removals = []
-    for line in operations:
-        if line[1] != 'removed' or tallier[line[2]] >= 0 or line[2] in [ upg[0] for upg in upgrades ] or line[2] in rem_names:
-            continue
+    try:
+        generation.rollback = compute_rollback([ generation ])
+
+    except OSError: # rollback will plan from scratch
+        generation.rollback = None
 
-        removals.append([line[2], line[3]])
-        rem_names.append(line[2])
+    write_generations(generations + [ generation ])
 
-    installs = [ [line[2], line[3]] for line in operations if line[1] == 'installed' and tallier[line[2]] > 0 ]
-    reinstalls = [ [line[2], line[3]] for line in operations if line[1] == 'reinstalled' ]
+def compute_rollback(generations: list[Generation]) -> PrecomputedRollback:
+    # generations to undo, oldest first; their operations are inverted together
+    oldest = generations[0]
+    timestamp = datetime.datetime.fromisoformat(oldest.timestamp)
 
-    package_glob = '*.pkg.tar.*[!.sig]'
-    pacman_cache = glob.glob(f'{PACMAN_CACHE_LOC}/{package_glob}')
-    aur_cache = glob.glob(f'{AUR_CACHE_LOC}/**/{package_glob}')
-    aur_rebuild_cache = glob.glob(f'{AUR_REBUILD_CACHE_LOC}/{timestamp.isoformat()}/**/{package_glob}', recursive=True)
+    log_stat = os.stat(PACMAN_LOG) # taken first, so that operations logged during planning make the plan stale
+    plan = plan_rollback(read_operations_since(timestamp, oldest.log_inode, oldest.log_offset))
 
-    upgrades_matched = search_cache(upgrades, pacman_cache, aur_cache)
-    installs_matched = [ line[0] for line in installs ]
-    removals_matched = search_cache(removals, pacman_cache, aur_cache)
-    reinstalls_matched = search_cache(reinstalls, [], aur_rebuild_cache)
+    cache_index = read_cache_index()
+    pacman_cache = index_cache(list_package_cache(PACMAN_CACHE_LOC, 0, cache_index))
+    aur_cache = index_cache(list_package_cache(AUR_CACHE_LOC, 1, cache_index) + list_package_cache(AUR_BUILD_CACHE_LOC, 1, cache_index))
+    aur_rebuild_cache = index_cache([ file for generation in generations for file in list_package_cache(generation.rebuild_cache, None, cache_index) ])
+    write_cache_index(cache_index)
+
+    upgrades_matched, upgrades_missed = search_cache(plan.upgrades, pacman_cache, aur_cache)
+    installs_matched = [ pkg[0] for pkg in plan.installs ]
+    removals_matched, removals_missed = search_cache(plan.removals, pacman_cache, aur_cache)
+    reinstalls_matched, reinstalls_missed = search_cache(plan.reinstalls, {}, aur_rebuild_cache)
 
     rollback_process_blueprint = [
         [ ['sudo', 'pacman', '-U', '--noconfirm'], upgrades_matched, None ], # must be first
@@ -226,10 +913,276 @@ def rollback_update():
         [ ['sudo', 'pacman', '-U', '--noconfirm'], reinstalls_matched, None ] # must be last; reinstall only packages reinstalled during an update
     ]
 
-    rollback_process = create_rollback_process(rollback_process_blueprint)
-    subprocess_run_sync(rollback_process)
+    return PrecomputedRollback(
+        oldest.timestamp,
+        log_stat.st_ino,
+        log_stat.st_size,
+        upgrades_matched + removals_matched + reinstalls_matched,
+        create_rollback_process(rollback_process_blueprint),
+        upgrades_missed + removals_missed + reinstalls_missed
+    )
+
+def read_precomputed_rollback(generation: Generation) -> PrecomputedRollback | None:
+    precomputed_rollback = generation.rollback
+    if precomputed_rollback is None:
+        return None
+
+    try:
+        log_stat = os.stat(PACMAN_LOG)
+
+    except OSError:
+        return None
+
+    if precomputed_rollback.timestamp != generation.timestamp\
+    or precomputed_rollback.log_inode != log_stat.st_ino\
+    or precomputed_rollback.log_size != log_stat.st_size\
+    or not all(os.path.isfile(file) for file in precomputed_rollback.cache_files):
+        return None
+
+    return precomputed_rollback
+
+def read_package_info(path: str) -> dict[str, str]:
+    pkginfo = subprocess.run(['bsdtar', '-xOf', path, '.PKGINFO'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    package_info = {}
+    for line in pkginfo.stdout.split('\n'):
+        key, separator, value = line.partition(' = ')
+
+        if separator != '' and not key.startswith('#'):
+            package_info.setdefault(key, value)
+
+    return package_info
+
+def verify_package(path: str) -> list[str]:
+    if subprocess.run(['bsdtar', '-tf', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+        return [ f'{path} is corrupted or truncated' ]
+
+    problems = []
+
+    package_info = read_package_info(path)
+    name, version = parse_package_filename(path)
+    if len(package_info) == 0:
+        problems.append(f'{path} has no package metadata')
+
+    elif package_info.get('pkgname') != name or package_info.get('pkgver') != version:
+        problems.append(f'{path} contains {package_info.get("pkgname")} {package_info.get("pkgver")} instead of {name} {version}')
+
+    if path.startswith(f'{PACMAN_CACHE_LOC}/') and not os.path.isfile(f'{path}.sig'): # locally built AUR packages are not signed
+        problems.append(f'{path} has no signature')
+
+    return problems
+
+def verify_rollback(rollback: PrecomputedRollback) -> None:
+    for name, version in rollback.cache_misses:
+        print(f'Warning: {name} {version} was not found in package caches and will not be restored.')
+
+    with concurrent.futures.ThreadPoolExecutor(VERIFY_WORKERS) as executor:
+        problems = [ problem for package_problems in executor.map(verify_package, rollback.cache_files) for problem in package_problems ]
+
+    if len(problems) > 0:
+        raise ValueError('\n'.join([ 'Rollback aborted, cached packages failed verification:', *problems ]))
+
+def read_rollback_generations() -> list[Generation]:
+    generations = read_generations()
+
+    # an empty generations file is not the same, gc --keep 0 removed everything the last update could be rolled back with
+    if not os.path.isfile(GENERATIONS_FILE) and os.path.isfile(TIMESTAMP_FILE): # last update ran before generations were kept
+        timestamp = read_timestamp().isoformat()
+        generations = [ Generation(timestamp, None, None, f'{AUR_REBUILD_CACHE_LOC}/{timestamp}', None) ]
+
+    return generations
+
+def rollback_update(generation_number: int):
+    generations = read_rollback_generations()
+
+    if len(generations) == 0:
+        raise FileNotFoundError('No update performed on this system yet')
+
+    if generation_number < 1 or generation_number > len(generations):
+        raise ValueError(f'Generation must be between 1 and {len(generations)}')
+
+    undone_generations = generations[-generation_number:]
+
+    rollback = read_precomputed_rollback(undone_generations[0]) if generation_number == 1 else None
+    if rollback is None: # stale, missing or spanning several updates, plan from scratch
+        rollback = compute_rollback(undone_generations)
+
+    verify_rollback(rollback)
+    subprocess_run_sync(rollback.rollback_process)
+
+    remaining_generations = generations[:-generation_number]
+    write_generations(remaining_generations)
+    write_timestamp(remaining_generations[-1].timestamp if len(remaining_generations) > 0 else None)
+
+def list_generations():
+    generations = read_rollback_generations()
+
+    if len(generations) == 0:
+        print('No update performed on this system yet.')
+
+        return
+
+    print(f'{"GENERATION":<12}{"UPDATE STARTED":<28}PLAN')
+    for number, generation in zip(range(len(generations), 0, -1), generations):
+        plan = 'precomputed' if read_precomputed_rollback(generation) is not None else 'computed on rollback'
+
+        print(f'{number:<12}{generation.timestamp:<28}{plan}')
+
+def parse_size(size: str) -> int:
+    units = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 }
+
+    multiplier = units.get(size[-1:].upper(), 1)
+    number = size[:-1] if size[-1:].upper() in units else size
+
+    try:
+        return int(float(number) * multiplier)
+
+    except ValueError:
+        raise ValueError(f'Invalid size {size}, use a number optionally followed by K, M, G or T')
+
+def get_installed_versions() -> set[tuple[str, str]]:
+    pacman_output = subprocess.run(['pacman', '-Q'], stdout=subprocess.PIPE, text=True)
+
+    return { tuple(line.split(' ', 1)) for line in pacman_output.stdout.split('\n')[:-1] }
+
+def files_size(files: set[str]) -> int:
+    return sum(os.path.getsize(file) for file in files if os.path.isfile(file))
+
+def remove_cache_files(files: list[str]) -> None:
+    pacman_files = [ file for file in files if file.startswith(f'{PACMAN_CACHE_LOC}/') ]
+    user_files = [ file for file in files if not file.startswith(f'{PACMAN_CACHE_LOC}/') ]
+
+    if len(pacman_files) > 0:
+        subprocess_run_sync([ [ cmd, None ] for cmd in batch_arguments(['sudo', 'rm', '-f'], pacman_files, None) ])
+
+    for file in user_files:
+        os.remove(file)
+
+def collect_garbage(keep: int | None, max_size: int | None):
+    generations = read_rollback_generations()
+
+    cache_index = read_cache_index()
+    cached_files = [ file for root, depth in CACHE_ROOTS for file in list_package_cache(root, depth, cache_index) ]
+    write_cache_index(cache_index)
+
+    installed_versions = get_installed_versions()
+    current_files = { file for file in cached_files if parse_package_filename(file) in installed_versions }
+
+    # kept files for retaining the latest 0, 1, ... generations
+    kept_files = [ current_files ]
+    for number in range(1, len(generations) + 1):
+        rollback = compute_rollback(generations[-number:])
+        kept_files.append(kept_files[-1] | set(rollback.cache_files))
+
+    retained = len(generations) if keep is None else min(keep, len(generations))
+    if max_size is not None:
+        while retained > 0 and files_size(kept_files[retained]) > max_size:
+            retained -= 1
+
+    retained_generations = generations[len(generations) - retained:]
+    retained_rebuild_caches = { generation.rebuild_cache for generation in retained_generations }
+
+    garbage_rebuild_caches = []
+    if os.path.isdir(AUR_REBUILD_CACHE_LOC):
+        garbage_rebuild_caches = [
+            f'{AUR_REBUILD_CACHE_LOC}/{directory}'
+            for directory in sorted(os.listdir(AUR_REBUILD_CACHE_LOC))
+            if f'{AUR_REBUILD_CACHE_LOC}/{directory}' not in retained_rebuild_caches
+        ]
+
+    garbage_files = [
+        file for file in cached_files
+        if file not in kept_files[retained] and not any(file.startswith(f'{directory}/') for directory in garbage_rebuild_caches)
+    ]
+    garbage_files += [ f'{file}.sig' for file in garbage_files if os.path.isfile(f'{file}.sig') ]
+
+    print(f'Keeping {retained} of {len(generations)} rollback generations and {len(kept_files[retained])} cached packages.')
+
+    if len(garbage_files) == 0 and len(garbage_rebuild_caches) == 0:
+        print('Nothing to remove.')
+
+        return
+
+    garbage_size = files_size(set(garbage_files)) + sum(
+        os.path.getsize(f'{path}/{file}') for directory in garbage_rebuild_caches for path, _, files in os.walk(directory) for file in files
+    )
+    choice = input(f'Remove {len(garbage_files)} cached files and {len(garbage_rebuild_caches)} rebuild cache directories ({garbage_size / 1024 ** 2:.1f} MiB)? y/N: ')
+
+    if choice == '' or choice not in 'Yy':
+        return
+
+    remove_cache_files(garbage_files)
+    for directory in garbage_rebuild_caches:
+        shutil.rmtree(directory)
+
+    write_generations(retained_generations)
+
+def inspect_cache_index(rebuild: bool):
+    cache_index = {} if rebuild else read_cache_index()
+
+    print(f'Package cache index at {CACHE_INDEX_FILE}:')
+    for root, depth in CACHE_ROOTS:
+        packages = list_package_cache(root, depth, cache_index)
+        directories = [ path for path in cache_index if path == root or path.startswith(f'{root}/') ]
+
+        print(f'{root:<40}{len(directories):>8} directories{len(packages):>8} packages')
+
+    write_cache_index(cache_index)
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+def format_trend(wall_times: list[float]) -> str:
+    if len(wall_times) <= STATS_TREND_RUNS:
+        return '-'
+
+    recent = statistics.median(wall_times[-STATS_TREND_RUNS:])
+    older = statistics.median(wall_times[:-STATS_TREND_RUNS])
 
-    write_timestamp()
+    if older == 0:
+        return '-'
+
+    return f'{(recent / older - 1) * 100:+.0f}%'
+
+def print_stats(pipeline_name: str | None):
+    history = [ record for record in read_step_history() if pipeline_name is None or record.pipeline == pipeline_name ]
+
+    if len(history) == 0:
+        print('No update runs recorded yet.')
+
+        return
+
+    pipelines = collections.defaultdict(lambda: collections.defaultdict(list))
+    for record in history:
+        pipelines[record.pipeline][record.step].append(record)
+
+    for name, steps in pipelines.items():
+        print(f'Pipeline {name}:')
+        print(f'{"STEP":<20}{"RUNS":>6}{"FAILED":>8}{"P50 [s]":>10}{"P90 [s]":>10}{"MAX [s]":>10}{"CPU P50 [s]":>13}{"RSS [MiB]":>11}{"TREND":>8}  COMMAND')
+
+        for step, records in steps.items():
+            successful = [ record for record in records if record.exit_status == 0 ]
+            wall_times = [ record.wall_time for record in successful ]
+            failed = len(records) - len(successful)
+
+            if len(successful) == 0:
+                print(f'{step:<20}{len(records):>6}{failed:>8}{"-":>10}{"-":>10}{"-":>10}{"-":>13}{"-":>11}{"-":>8}  {records[-1].command}')
+
+                continue
+
+            p50, p90, slowest = percentile(wall_times, 0.5), percentile(wall_times, 0.9), max(wall_times)
+            cpu_p50 = percentile([ record.cpu_time for record in successful ], 0.5)
+            max_rss = max(record.max_rss for record in successful) / 1024
+
+            print(f'{step:<20}{len(records):>6}{failed:>8}{p50:>10.1f}{p90:>10.1f}{slowest:>10.1f}{cpu_p50:>13.1f}{max_rss:>11.1f}{format_trend(wall_times):>8}  {records[-1].command}')
+
+        print()
+
+    # a forked child keeps the peak of its parent across exec, so no step reports less than sysman itself used
+    sysman_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'RSS is the peak resident size of a step, which includes the size of sysman when it started the step (about {sysman_rss:.0f} MiB). Values close to that say nothing about the step.')
 
 def generate():
     if os.path.isfile(PIPELINE_FILE):
@@ -237,7 +1190,9 @@ def generate():
 
     stub_full_pipeline = [
         UpdateStep('put your update command here', 'put a (case sensitive) keyword here to use special environment, leave this field empty to not use it; valid keywords are explained below'),
-        UpdateStep('commands defined here run sequentially', 'cache_rebuild -> modifies XDG_CACHE_HOME, use this keyword when rebuilding AUR packages')
+        UpdateStep('commands defined here run sequentially', 'cache_rebuild -> modifies XDG_CACHE_HOME, use this keyword when rebuilding AUR packages'),
+        UpdateStep('(optional) id names the step, needs lists ids of steps it waits for; a step without needs waits for the previous step', '', 'independent-step', []),
+        UpdateStep('steps with satisfied needs run in parallel, so they should not prompt for input', '', 'dependent-step', [ 'independent-step' ])
     ]
 
     stub_minimal_pipeline = [
@@ -269,18 +1224,27 @@ def help():
     print('Usage: sysman update COMMAND')
     print()
     print('Available COMMANDs:')
-    print(f'{"help":<20}Prints this message.')
-    print(f'{"generate":<20}Generates an empty pipeline file.')
-    print(f'{"edit":<20}Opens the pipeline file in $EDITOR.')
-    print(f'{"run [PIPELINE_NAME]":<20}Updates the system using PIPELINE_NAME pipeline (or first one if PIPELINE_NAME is not given) defined in the pipeline file.')
-    print(f'{"rollback":<20}Rollbacks the system to the state before the last update. All changes in packages (installs, uninstalls) since that time will be lost!')
+    print(f'{"help":<24}Prints this message.')
+    print(f'{"generate":<24}Generates an empty pipeline file.')
+    print(f'{"edit":<24}Opens the pipeline file in $EDITOR.')
+    print(f'{"run [PIPELINE_NAME]":<24}Updates the system using PIPELINE_NAME pipeline (or first one if PIPELINE_NAME is not given) defined in the pipeline file.')
+    print(f'{"stats [PIPELINE_NAME]":<24}Prints timing statistics of steps of PIPELINE_NAME pipeline (or all pipelines if PIPELINE_NAME is not given) from previous runs.')
+    print(f'{"gc [--keep N]":<24}Removes cached packages and rebuild caches not needed to rollback the N latest updates (or all kept ones if N is not given) nor to reinstall current versions.')
+    print(f'{"gc [--max-size SIZE]":<24}As above, keeping as many latest updates as fit in SIZE (e.g. 10G) of cached packages.')
+    print(f'{"cache-index [rebuild]":<24}Refreshes and prints the package cache index, or rebuilds it from scratch if rebuild is given.')
+    print(f'{"generations":<24}Lists updates that can be rolled back, numbered from the most recent one.')
+    print(f'{"rollback [--to N]":<24}Rollbacks the system to the state before the last update, or before the N-th most recent update if N is given. All changes in packages (installs, uninstalls) since that time will be lost!')
 
 def main(args: list[str]):
     pathlib.Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
 
     if len(args) == 0\
-    or (len(args) == 1 and args[0] not in [ 'generate', 'edit', 'run', 'rollback' ])\
-    or (len(args) == 2 and args[0] not in  [ 'run' ]):
+    or len(args) > 3\
+    or (len(args) == 1 and args[0] not in [ 'generate', 'edit', 'run', 'stats', 'generations', 'rollback', 'gc', 'cache-index' ])\
+    or (len(args) == 2 and args[0] not in  [ 'run', 'stats', 'cache-index' ])\
+    or (len(args) == 2 and args[0] == 'cache-index' and args[1] != 'rebuild')\
+    or (len(args) == 3 and [ args[0], args[1] ] not in [ [ 'rollback', '--to' ], [ 'gc', '--keep' ], [ 'gc', '--max-size' ] ])\
+    or (len(args) == 3 and args[1] in [ '--to', '--keep' ] and not args[2].isdigit()):
         help()
 
     elif args[0] == 'generate':
@@ -292,8 +1256,23 @@ def main(args: list[str]):
     elif args[0] == 'run':
         update_system(args[1] if len(args) == 2 else None)
     
+    elif args[0] == 'stats':
+        print_stats(args[1] if len(args) == 2 else None)
+
+    elif args[0] == 'gc':
+        collect_garbage(
+            int(args[2]) if len(args) == 3 and args[1] == '--keep' else None,
+            parse_size(args[2]) if len(args) == 3 and args[1] == '--max-size' else None
+        )
+
+    elif args[0] == 'cache-index':
+        inspect_cache_index(len(args) == 2)
+
+    elif args[0] == 'generations':
+        list_generations()
+
     elif args[0] == 'rollback':
         choice = input('Are you sure? y/N: ')
 
         if choice != '' and choice in 'Yy':
-            rollback_update()
+            rollback_update(int(args[2]) if len(args) == 3 else 1)
@@ -0,0 +1,361 @@
+_name = 'watch'
+_desc = 'Keep track of drift between the package and service files and the system in the background.'
+
+import ctypes
+import ctypes.util
+import json
+import os
+import runpy
+import selectors
+import socket
+import struct
+import time
+from dataclasses import dataclass, asdict
+
+
+MODULES_DIR = os.path.dirname(os.path.realpath(__file__))
+PACKAGE_MODULE = f'{MODULES_DIR}/package.py'
+SERVICE_MODULE = f'{MODULES_DIR}/service.py'
+RUNTIME_DIR = os.environ.get('XDG_RUNTIME_DIR', f'{os.environ["HOME"]}/.config/sysman/tmp')
+SOCKET_PATH = f'{RUNTIME_DIR}/sysman-watch.sock'
+PACMAN_DB_DIR = '/var/lib/pacman'
+DEBOUNCE = 1.0 # seconds without changes before the drift is recomputed, a pacman transaction touches many files
+POLL_INTERVAL = 5.0 # seconds between scans when inotify is not available
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+@dataclass
+class Drift:
+    packages_missing: list[str] # declared in the package file, not installed
+    packages_extra: list[str] # explicitly installed, not declared
+    services_inactive: list[str] # declared in the service file, not enabled
+    packages_updated: float | None
+    services_updated: float | None
+    errors: dict[str, str] # side that failed to recompute -> reason
+
+
+class Inotify():
+    def __init__(self) -> None:
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.__watches = {}
+
+        self.fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify is not available')
+
+    def watch(self, directory: str) -> None:
+        wd = self.__libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+
+        if wd >= 0: # missing directories are skipped, they are watched again after the next recompute
+            self.__watches[wd] = directory
+
+    def read(self) -> list[str | None]:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+
+        except BlockingIOError:
+            return []
+
+        changed_paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW or wd == -1: # events were dropped, anything could have changed
+                changed_paths.append(None)
+
+            elif wd in self.__watches:
+                changed_paths.append(f'{self.__watches[wd]}/{os.fsdecode(name)}' if name else self.__watches[wd])
+
+        return changed_paths
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+last_listfile_paths: list[str] = []
+
+
+def get_listfile_paths(package: dict) -> list[str]:
+    listfile = package['LISTFILE']
+
+    paths = [ listfile ]
+    seen = { os.path.realpath(listfile) }
+    try:
+        for path in paths: # grows while iterating, includes of includes
+            if not os.path.exists(path):
+                continue
+
+            for include in package['read_listfile'](path).includes:
+                included_path = package['include_path'](path, include)
+
+                if os.path.realpath(included_path) not in seen: # include cycles are reported by the recompute
+                    seen.add(os.path.realpath(included_path))
+                    paths.append(included_path)
+
+    except (OSError, ValueError, TypeError, KeyError): # e.g. a file saved halfway through editing
+        return list(last_listfile_paths) if len(last_listfile_paths) > 0 else paths
+
+    last_listfile_paths[:] = paths
+
+    return paths
+
+def get_unit_roots(service: dict) -> list[str]:
+    unit_roots = []
+    for paths in list(service['UNIT_SEARCH_PATHS'].values()) + list(service['UNIT_CONFIG_PATHS'].values()):
+        unit_roots.extend(path for path in paths if path not in unit_roots)
+
+    return unit_roots
+
+def get_unit_dirs(service: dict) -> list[str]:
+    unit_dirs = []
+    for unit_root in get_unit_roots(service):
+        if not os.path.isdir(unit_root):
+            continue
+
+        unit_dirs.append(unit_root)
+        unit_dirs.extend(entry.path for entry in os.scandir(unit_root) if entry.is_dir() and entry.name.endswith(('.wants', '.requires', '.upholds')))
+
+    return unit_dirs
+
+def get_watched_dirs(package: dict, service: dict) -> list[str]:
+    watched_dirs = [ PACMAN_DB_DIR, f'{PACMAN_DB_DIR}/local' ]
+    watched_dirs.extend({ os.path.dirname(path) for path in get_listfile_paths(package) + [ service['SERVICEFILE'] ] })
+    watched_dirs.extend(get_unit_dirs(service))
+
+    return watched_dirs
+
+def changed_sides(paths: list[str | None], package: dict, service: dict) -> set[str]:
+    listfile_paths = set(get_listfile_paths(package))
+
+    sides = set()
+    for path in paths:
+        if path is None: # inotify queue overflowed
+            sides |= { 'packages', 'services' }
+
+        elif path.startswith(f'{PACMAN_DB_DIR}/') or path == PACMAN_DB_DIR or path in listfile_paths:
+            sides.add('packages')
+
+        elif path == service['SERVICEFILE'] or any(path.startswith(f'{unit_root}/') for unit_root in get_unit_roots(service)):
+            sides.add('services')
+
+    return sides
+
+def snapshot(package: dict, service: dict) -> dict[str, int]:
+    # polling fallback, directory mtimes change whenever entries are added, removed or renamed
+    mtimes = {}
+    for path in get_watched_dirs(package, service) + get_listfile_paths(package) + [ service['SERVICEFILE'] ]:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+
+        except OSError:
+            mtimes[path] = None
+
+    return mtimes
+
+def compute_packages(drift: Drift, package: dict) -> None:
+    listfile_packages = package['get_listfile_packages'](package['LISTFILE'])
+    system_packages = package['get_all_packages']()
+
+    drift.packages_missing = sorted(pkg.name for pkg in listfile_packages - system_packages)
+    drift.packages_extra = sorted(pkg.name for pkg in system_packages - listfile_packages)
+    drift.packages_updated = time.time()
+
+def compute_services(drift: Drift, service: dict) -> None:
+    services = []
+    if os.path.isfile(service['SERVICEFILE']):
+        servicefile = service['read_file_to_servicefile'](service['SERVICEFILE'])
+        services = servicefile.get_all_services() + servicefile.get_all_local_services()
+
+    drift.services_inactive = sorted(
+        f'{svc.name} ({svc.svc_type}, {state})'
+        for svc, state in service['get_states_of_services'](services)
+        if state != 'enabled'
+    )
+    drift.services_updated = time.time()
+
+def recompute(drift: Drift, sides: set[str], package: dict, service: dict) -> None:
+    for side, compute, module in [ ('packages', compute_packages, package), ('services', compute_services, service) ]:
+        if side not in sides:
+            continue
+
+        try:
+            compute(drift, module)
+            drift.errors.pop(side, None)
+
+        except Exception as e: # e.g. a file saved halfway through editing, the next change recomputes again
+            drift.errors[side] = str(e)
+
+def answer(server: socket.socket, drift: Drift) -> None:
+    connection, _ = server.accept()
+
+    with connection:
+        try:
+            connection.sendall(json.dumps(asdict(drift)).encode() + b'\n')
+
+        except OSError: # client went away
+            pass
+
+def open_server() -> socket.socket:
+    os.makedirs(RUNTIME_DIR, exist_ok=True)
+
+    if os.path.exists(SOCKET_PATH):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            try:
+                client.connect(SOCKET_PATH)
+
+            except OSError: # left behind by a daemon that did not exit cleanly
+                os.remove(SOCKET_PATH)
+
+            else:
+                raise FileExistsError(f'Watch daemon is already running at {SOCKET_PATH}')
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(SOCKET_PATH)
+    server.listen()
+
+    return server
+
+def run():
+    package = runpy.run_path(PACKAGE_MODULE)
+    service = runpy.run_path(SERVICE_MODULE)
+
+    drift = Drift([], [], [], None, None, {})
+    recompute(drift, { 'packages', 'services' }, package, service)
+
+    try:
+        inotify = Inotify()
+
+    except (OSError, AttributeError): # no inotify in this libc
+        inotify = None
+        print(f'inotify is not available, checking for changes every {POLL_INTERVAL} seconds.')
+
+    server = open_server()
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+
+    if inotify is not None:
+        selector.register(inotify.fd, selectors.EVENT_READ)
+
+        for directory in get_watched_dirs(package, service):
+            inotify.watch(directory)
+
+    else:
+        mtimes = snapshot(package, service)
+        next_poll = time.monotonic() + POLL_INTERVAL
+
+    print(f'Watching for changes, status is served at {SOCKET_PATH}.')
+
+    pending_sides = set()
+    deadline = None
+    try:
+        while True:
+            timeouts = [ deadline - time.monotonic() if deadline is not None else None, next_poll - time.monotonic() if inotify is None else None ]
+            timeouts = [ timeout for timeout in timeouts if timeout is not None ]
+
+            for key, _ in selector.select(max(min(timeouts), 0) if len(timeouts) > 0 else None):
+                if key.fileobj is server:
+                    answer(server, drift)
+
+                else:
+                    pending_sides |= changed_sides(inotify.read(), package, service)
+                    deadline = time.monotonic() + DEBOUNCE if len(pending_sides) > 0 else deadline
+
+            if inotify is None and time.monotonic() >= next_poll:
+                new_mtimes = snapshot(package, service)
+                pending_sides |= changed_sides([ path for path in new_mtimes if new_mtimes[path] != mtimes.get(path) ], package, service)
+                deadline = time.monotonic() if len(pending_sides) > 0 else deadline
+
+                mtimes = new_mtimes
+                next_poll = time.monotonic() + POLL_INTERVAL
+
+            if deadline is not None and time.monotonic() >= deadline:
+                recompute(drift, pending_sides, package, service)
+                pending_sides = set()
+                deadline = None
+
+                if inotify is not None: # new .wants directories, new includes
+                    for directory in get_watched_dirs(package, service):
+                        inotify.watch(directory)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        selector.close()
+        server.close()
+        os.remove(SOCKET_PATH)
+
+        if inotify is not None:
+            inotify.close()
+
+def read_status() -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(SOCKET_PATH)
+
+        except OSError:
+            raise ConnectionError('Watch daemon is not running. Start it using sysman watch run.')
+
+        response = b''
+        while chunk := client.recv(64 * 1024):
+            response += chunk
+
+    return json.loads(response)
+
+def status(as_json: bool):
+    drift = read_status()
+
+    if as_json:
+        print(json.dumps(drift))
+
+        return
+
+    for side, error in drift['errors'].items():
+        print(f'Last recompute of {side} failed: {error}')
+
+    for label, key in [
+        ('Packages missing from the system', 'packages_missing'),
+        ('Packages missing from the package file', 'packages_extra'),
+        ('Services not enabled', 'services_inactive')
+    ]:
+        if len(drift[key]) > 0:
+            print(f'{label} ({len(drift[key])}):')
+            print(', '.join(drift[key]))
+
+    if len(drift['errors']) == 0 and all(len(drift[key]) == 0 for key in [ 'packages_missing', 'packages_extra', 'services_inactive' ]):
+        print('System is in sync with the package and service files.')
+
+def help():
+    print('Usage: sysman watch COMMAND')
+    print()
+    print('Available COMMANDs:')
+    print(f'{"help":<20}Prints this message.')
+    print(f'{"run":<20}Runs the daemon, which watches the system, the package file and the service file and keeps track of differences between them.')
+    print(f'{"status [--json]":<20}Prints the differences tracked by the running daemon, as JSON if --json is given.')
+
+def main(args: list[str]):
+    if len(args) == 0\
+    or (len(args) == 1 and args[0] not in [ 'run', 'status' ])\
+    or (len(args) == 2 and args != [ 'status', '--json' ])\
+    or len(args) > 2:
+        help()
+
+    elif args[0] == 'run':
+        run()
+
+    elif args[0] == 'status':
+        status(len(args) == 2)